@@ -0,0 +1,67 @@
+"""Load test micro-batching with a stand-in model.
+
+Usage:
+    python -m benchmarks.batching_load
+
+Prints throughput and latency against the number of concurrent clients,
+with and without a batching window.
+"""
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from modules.data.receipt_data import ReceiptData
+from modules.models.base import AIModel
+from modules.models.batching import MicroBatcher
+
+
+class FakeBatchModel(AIModel):
+    """Stand-in whose batch cost grows slower than its size, like Donut."""
+
+    def __init__(self, fixed_cost: float = 0.4, cost_per_image: float = 0.05) -> None:
+        self.fixed_cost = fixed_cost
+        self.cost_per_image = cost_per_image
+        # one batch at a time, as on a single CPU/GPU
+        self._device = threading.Lock()
+
+    def run(self, image: Image.Image) -> ReceiptData:
+        return self.run_batch([image])[0]
+
+    def run_batch(self, images: list[Image.Image]) -> list[ReceiptData]:
+        with self._device:
+            time.sleep(self.fixed_cost + self.cost_per_image * len(images))
+        return [ReceiptData(items={}, total=0.0) for _ in images]
+
+
+def main(requests: int = 120) -> None:
+    image = Image.new("RGB", (8, 8))
+    print("window  clients  throughput   p50     p95   mean batch")
+    for window_ms in (0, 30):
+        for clients in (1, 2, 4, 8, 16):
+            model = MicroBatcher(FakeBatchModel(), window_ms=window_ms)
+
+            def timed(_) -> float:
+                # clients arrive at random moments
+                time.sleep(random.uniform(0, 0.05))
+                start = time.perf_counter()
+                model.run(image)
+                return time.perf_counter() - start
+
+            count = min(requests, clients * 8)
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=clients) as executor:
+                latencies = sorted(executor.map(timed, range(count)))
+            elapsed = time.perf_counter() - start
+            mean_batch = model.stats.mean_batch_size if window_ms else 1.0
+            print(
+                f"{window_ms:4.0f}ms  {clients:7d}  {count / elapsed:6.1f} req/s  "
+                f"{latencies[len(latencies) // 2]:5.2f}s  "
+                f"{latencies[int(len(latencies) * 0.95)]:5.2f}s  {mean_batch:6.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
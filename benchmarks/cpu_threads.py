@@ -0,0 +1,51 @@
+"""Measure concurrent torch inferences with and without the thread budget.
+
+Usage:
+    python -m benchmarks.cpu_threads
+
+Prints throughput and p95 at 1, 2, 4 and 8 concurrent receipts. Each
+receipt is a stand-in for a Donut decode: `steps` passes through a stack of
+decoder-sized Linear layers, run with torch's default threading and then
+within the budget.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from modules.models.threads import CPU_THREADS, ThreadBudget
+
+
+def main(receipts: int = 16, steps: int = 64) -> None:
+    layers = torch.nn.Sequential(*[torch.nn.Linear(1024, 1024) for _ in range(4)]).eval()
+    hidden = torch.randn(16, 1024)
+
+    def decode(budget: ThreadBudget | None) -> float:
+        start = time.perf_counter()
+        with torch.inference_mode():
+            if budget is None:
+                for _ in range(steps):
+                    layers(hidden)
+            else:
+                with budget.slot():
+                    for _ in range(steps):
+                        layers(hidden)
+        return time.perf_counter() - start
+
+    print(f"{CPU_THREADS} cores")
+    print("threading  concurrent  throughput      p95")
+    for name in ("default", "budget"):
+        for concurrency in (1, 2, 4, 8):
+            budget = ThreadBudget() if name == "budget" else None
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                latencies = sorted(executor.map(lambda _: decode(budget), range(receipts)))
+            elapsed = time.perf_counter() - start
+            print(
+                f"{name:9}  {concurrency:10d}  {receipts / elapsed:6.2f} rec/s  "
+                f"{latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]:6.2f}s"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Compare the memory and latency of the fp32 and the int8 Donut model.
+
+Usage:
+    python -m benchmarks.donut_int8
+
+Prints the RSS, encoder latency and decoding latency of each model, each
+measured in a fresh process. The weights are random, from a config
+approximating the published donut-base-finetuned-cord-v2 one (Swin-B
+encoder at 1280x960, 4 layer MBart decoder), so the greedy decode is forced
+to `tokens` tokens. The field accuracy is compared by
+`benchmarks.donut_int8_accuracy` on the real weights.
+"""
+import subprocess
+import sys
+import tempfile
+
+from transformers import (
+    DonutSwinConfig,
+    MBartConfig,
+    VisionEncoderDecoderConfig,
+    VisionEncoderDecoderModel,
+)
+
+# Run in a fresh interpreter: RSS loaded and after a receipt, encoder
+# seconds and decoder seconds per token of the model in the given directory
+_SCRIPT = """
+import sys, time, torch
+from transformers import VisionEncoderDecoderModel
+from modules.models.donut import _quantize, _release_freed_memory
+from modules.models.residency import current_rss
+model = VisionEncoderDecoderModel.from_pretrained(sys.argv[1]).eval()
+if sys.argv[2] == "int8":
+    # as _load_quantized_model does
+    model = _quantize(model)
+    _release_freed_memory()
+loaded = current_rss()
+pixel_values = torch.randn(1, 3, 1280, 960)
+tokens = int(sys.argv[3])
+with torch.inference_mode():
+    model.generate(pixel_values, decoder_input_ids=torch.tensor([[0]]), max_new_tokens=2)
+    start = time.perf_counter()
+    encoder_outputs = model.encoder(pixel_values)
+    encoder = time.perf_counter() - start
+    start = time.perf_counter()
+    model.generate(
+        encoder_outputs=encoder_outputs, decoder_input_ids=torch.tensor([[0]]),
+        max_new_tokens=tokens, min_new_tokens=tokens, num_beams=1, use_cache=True,
+    )
+    decoder = (time.perf_counter() - start) / tokens
+print(loaded, current_rss(), encoder, decoder)
+"""
+
+
+def main(tokens: int = 64, repeat: int = 3) -> None:
+    encoder = DonutSwinConfig(
+        image_size=[1280, 960], embed_dim=128, depths=[2, 2, 14, 2],
+        num_heads=[4, 8, 16, 32], window_size=10,
+    )
+    decoder = MBartConfig(
+        vocab_size=57580, d_model=1024, decoder_layers=4, decoder_attention_heads=16,
+        decoder_ffn_dim=4096, max_position_embeddings=768, is_decoder=True,
+        add_cross_attention=True, scale_embedding=True, add_final_layer_norm=True,
+    )
+    config = VisionEncoderDecoderConfig.from_encoder_decoder_configs(encoder, decoder)
+    config.decoder_start_token_id, config.pad_token_id, config.eos_token_id = 0, 1, 2
+
+    with tempfile.TemporaryDirectory() as weights:
+        VisionEncoderDecoderModel(config).save_pretrained(weights)
+        print("model   RSS loaded  RSS after run  encoder  decoder/token")
+        for profile in ("fp32", "int8"):
+            runs = []
+            for _ in range(repeat):
+                output = subprocess.run(
+                    [sys.executable, "-c", _SCRIPT, weights, profile, str(tokens)],
+                    capture_output=True, text=True, check=True,
+                ).stdout.split()
+                runs.append([float(value) for value in output[-4:]])
+            # best of the runs, per column
+            loaded, after_run, encoder_seconds, decoder_seconds = map(min, zip(*runs))
+            print(
+                f"{profile:6}  {loaded / 2**20:7.0f} MB  {after_run / 2**20:10.0f} MB  "
+                f"{encoder_seconds:6.2f}s  {decoder_seconds * 1000:9.1f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
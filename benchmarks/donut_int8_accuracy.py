@@ -0,0 +1,74 @@
+"""Compare the fields read by the fp32 and the int8 Donut model.
+
+Usage:
+    python -m benchmarks.donut_int8_accuracy [IMAGE ...]
+
+The fp32 reading of each receipt is the reference. For every image the
+items read identically by the int8 model (same name, count and price), the
+items only one of the models read and whether the totals agree are printed,
+followed by the reading time of both models.
+"""
+import sys
+import time
+from pathlib import Path
+
+from PIL import Image
+
+from modules.data.receipt_data import ReceiptData
+from modules.models.donut import DonutModel
+
+SAMPLES = ["receipt1.jpg", "receipt2.png", "receipt3.png"]
+
+
+def _fields(receipt: ReceiptData) -> list[tuple[str, int, float]]:
+    return sorted(
+        (item.name.strip(), item.count, round(item.total_price, 2))
+        for item in receipt.items.values()
+    )
+
+
+def _read(model: DonutModel, image: Image.Image) -> tuple[ReceiptData, float]:
+    start = time.perf_counter()
+    receipt = model.run(image)
+    return receipt, time.perf_counter() - start
+
+
+def main(paths: list[str]) -> None:
+    root = Path(__file__).parents[1]
+    images = {path: Image.open(root / path).convert("RGB") for path in paths}
+    # one model at a time, both together do not fit small machines
+    readings = {}
+    for profile, quantized in (("fp32", False), ("int8", True)):
+        model = DonutModel(quantized=quantized)
+        readings[profile] = {path: _read(model, image) for path, image in images.items()}
+        del model
+
+    print("image          items  same  fp32 only  int8 only  total  fp32 time  int8 time")
+    same_items = reference_items = same_totals = 0
+    for path in paths:
+        reference, reference_seconds = readings["fp32"][path]
+        quantized, quantized_seconds = readings["int8"][path]
+        expected, actual = _fields(reference), _fields(quantized)
+        remaining = list(actual)
+        same = 0
+        for fields in expected:
+            if fields in remaining:
+                remaining.remove(fields)
+                same += 1
+        total_same = round(reference.total, 2) == round(quantized.total, 2)
+        same_items += same
+        reference_items += len(expected)
+        same_totals += total_same
+        print(
+            f"{path:13}  {len(expected):5}  {same:4}  {len(expected) - same:9}  "
+            f"{len(remaining):9}  {'same' if total_same else 'diff':5}  "
+            f"{reference_seconds:8.2f}s  {quantized_seconds:8.2f}s"
+        )
+    print(
+        f"items read identically: {same_items}/{reference_items}, "
+        f"totals identical: {same_totals}/{len(paths)}"
+    )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or SAMPLES)
@@ -0,0 +1,120 @@
+"""Compare the single-pass Donut sequence parser with the xmltodict path
+it replaced.
+
+Usage:
+    python -m benchmarks.donut_parser
+
+Prints the items and totals recovered, and the time per sequence, of both
+parsers. The corpus is synthetic CORD sequences of 1 to 30 items,
+well-formed, with three random closing tags dropped, and cut short as when
+the token budget runs out. Times are the best of `repeat` passes.
+"""
+import random
+import re
+import time
+
+from modules.data.receipt_data import ItemData, ReceiptData
+from modules.models.donut import _SequenceParser, _convert_price_str_to_float
+from modules.utils import cleanup_text
+
+
+def parse_with_xmltodict(sequence: str) -> ReceiptData:
+    """The xmltodict plus regex fallback path replaced by `_SequenceParser`."""
+    import xmltodict
+
+    sequence = sequence.replace("</s>", "").replace("<pad>", "")
+    sequence = sequence.replace("</s_cord-v2>", "") + "</s_cord-v2>"
+    try:
+        receipt_dict = xmltodict.parse(sequence)
+    except Exception:
+        names = re.findall(r"<s_nm>(.*?)</s_nm>", sequence)
+        counts = re.findall(r"<s_cnt>(.*?)</s_cnt>", sequence)
+        prices = re.findall(r"<s_price>(.*?)</s_price>", sequence)
+        total_match = re.search(r"<s_total_price>(.*?)</s_total_price>", sequence)
+        min_len = min(len(names), len(counts), len(prices))
+        receipt_dict = {"s_cord-v2": {
+            "s_menu": {"s_nm": names[:min_len], "s_cnt": counts[:min_len], "s_price": prices[:min_len]},
+            "s_total": {"s_total_price": total_match.group(1) if total_match else "0"},
+        }}
+
+    data_dict = receipt_dict["s_cord-v2"]
+    items = [
+        ItemData(name=cleanup_text(name), count=int(count), total_price=_convert_price_str_to_float(price))
+        for name, count, price in zip(
+            data_dict["s_menu"]["s_nm"], data_dict["s_menu"]["s_cnt"], data_dict["s_menu"]["s_price"]
+        )
+    ]
+    total_data = data_dict.get("s_total", {}).get("s_total_price", "0")
+    if isinstance(total_data, dict):
+        total_data = total_data.get("#text", "0")
+    return ReceiptData(
+        items={item.id: item for item in items},
+        total=_convert_price_str_to_float(str(total_data)),
+    )
+
+
+def main(sequences: int = 200, repeat: int = 5, seed: int = 0) -> None:
+    rng = random.Random(seed)
+    names = ["NASI GORENG", "ES TEH", "AYAM BAKAR", "Bintang Bremer", "CUMI GRG TEPUNG T", "Black Tea"]
+
+    def sample() -> tuple[str, list[tuple[str, int, float]], float]:
+        items = [
+            (rng.choice(names), rng.randint(1, 4), rng.randint(1, 200) * 1000.0)
+            for _ in range(rng.randint(1, 30))
+        ]
+        total = sum(price for _, _, price in items)
+        menu = "<sep/>".join(
+            f"<s_nm>{name}</s_nm><s_cnt>{count}</s_cnt><s_price>{price:,.0f}</s_price>"
+            for name, count, price in items
+        )
+        sequence = (
+            f"<s_cord-v2><s_menu>{menu}</s_menu>"
+            f"<s_total><s_total_price>{total:,.0f}</s_total_price></s_total></s_cord-v2></s>"
+        )
+        return sequence, items, total
+
+    def drop_closing_tags(sequence: str) -> str:
+        closing = [match.span() for match in re.finditer(r"</s_[a-z_]+>", sequence)]
+        for start, end in sorted(rng.sample(closing, 3), reverse=True):
+            sequence = sequence[:start] + sequence[end:]
+        return sequence
+
+    def truncate(sequence: str) -> str:
+        return sequence[: rng.randint(len(sequence) // 2, len(sequence) - 1)]
+
+    def parse_single_pass(sequence: str) -> ReceiptData:
+        parser = _SequenceParser()
+        parser.feed(sequence)
+        return parser.finish()
+
+    corpus = [sample() for _ in range(sequences)]
+    expected_items = sum(len(items) for _, items, _ in corpus)
+    print(f"{sequences} sequences, {expected_items} items")
+    print("variant      parser        items  totals   us/seq")
+    for variant, damage in (("well-formed", None), ("unclosed", drop_closing_tags), ("truncated", truncate)):
+        damaged = [damage(sequence) if damage else sequence for sequence, _, _ in corpus]
+        for name, parse in (("xmltodict", parse_with_xmltodict), ("single-pass", parse_single_pass)):
+            elapsed = float("inf")
+            for _ in range(repeat):
+                receipts = []
+                start = time.perf_counter()
+                for sequence in damaged:
+                    try:
+                        receipts.append(parse(sequence))
+                    except Exception:
+                        # the model returns an empty receipt on failure
+                        receipts.append(ReceiptData(items={}, total=0.0))
+                elapsed = min(elapsed, (time.perf_counter() - start) / sequences * 1e6)
+
+            found_items = found_totals = 0
+            for receipt, (_, items, total) in zip(receipts, corpus):
+                found = [(item.name, item.count, item.total_price) for item in receipt.items.values()]
+                found_items += sum(min(found.count(item), items.count(item)) for item in set(items))
+                found_totals += receipt.total == total
+            print(
+                f"{variant:11}  {name:11}  {found_items:6d}  {found_totals:6d}  {elapsed:7.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
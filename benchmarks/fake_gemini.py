@@ -0,0 +1,56 @@
+"""Offline stand-in for the Gemini chat model.
+
+Used by the app when GEMINI_FAKE_API=1, and by `benchmarks.gemini_load`.
+"""
+import asyncio
+import json
+import random
+from typing import AsyncIterator
+
+
+class FakeGeminiLLM:
+    """Offline stand-in for the Gemini chat model, for load testing.
+
+    Answers with a fixed receipt after a random latency, and fails a given
+    fraction of the calls with a rate limit error.
+    """
+
+    class ResourceExhausted(Exception):
+        code = 429
+
+    class _Response:
+        def __init__(self, content: str) -> None:
+            self.content = content
+
+    RESPONSE = json.dumps({
+        "menus": [
+            {"name": "Nasi Goreng", "count": 2, "price": 40000},
+            {"name": "Es Teh", "count": 1, "price": 5000},
+        ],
+        "total": 45000,
+    })
+
+    def __init__(
+        self, mean_latency: float = 2.0, error_rate: float = 0.05
+    ) -> None:
+        self.mean_latency = mean_latency
+        self.error_rate = error_rate
+        self.calls = 0
+
+    async def ainvoke(self, messages: list) -> "_Response":
+        self.calls += 1
+        await asyncio.sleep(random.expovariate(1 / self.mean_latency))
+        if random.random() < self.error_rate:
+            raise self.ResourceExhausted("429 quota exceeded")
+        return self._Response(self.RESPONSE)
+
+    def invoke(self, messages: list) -> "_Response":
+        return asyncio.run(self.ainvoke(messages))
+
+    async def astream(self, messages: list) -> AsyncIterator["_Response"]:
+        response = await self.ainvoke(messages)
+        # about 16 characters per chunk, as if generated token by token
+        step = 16
+        for start in range(0, len(response.content), step):
+            await asyncio.sleep(0.01)
+            yield self._Response(response.content[start:start + step])
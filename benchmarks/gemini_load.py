@@ -0,0 +1,47 @@
+"""Load test the Gemini client against the offline fake endpoint.
+
+Usage:
+    python -m benchmarks.gemini_load
+
+Prints the throughput and tail latency of `requests` concurrent readings
+of `distinct` receipts, and how many API calls they made.
+"""
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from modules.models.gemini_client import AsyncGeminiClient
+from modules.models.rate_limit import GeminiLimiter
+
+from .fake_gemini import FakeGeminiLLM
+
+
+def main(requests: int = 200, distinct: int = 50) -> None:
+    llm = FakeGeminiLLM(mean_latency=0.5)
+    limiter = GeminiLimiter(requests_per_minute=6000, tokens_per_minute=10**9)
+    client = AsyncGeminiClient(llm, call_timeout=5.0, limiter=limiter)
+
+    def timed(key: str) -> float:
+        start = time.perf_counter()
+        client.invoke(key, [])
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    keys = [f"receipt-{random.randrange(distinct)}" for _ in range(requests)]
+    with ThreadPoolExecutor(max_workers=64) as executor:
+        latencies = sorted(executor.map(timed, keys))
+    elapsed = time.perf_counter() - start
+
+    def percentile(p: float) -> float:
+        return latencies[min(int(p * len(latencies)), len(latencies) - 1)]
+
+    print(f"{requests} requests, {llm.calls} API calls in {elapsed:.2f}s")
+    print(f"throughput: {requests / elapsed:.1f} req/s")
+    print(
+        f"p50 {percentile(0.5):.2f}s  p95 {percentile(0.95):.2f}s  "
+        f"p99 {percentile(0.99):.2f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""Measure the startup cost of the LayoutLMv3 backend.
+
+Usage:
+    python -m benchmarks.layoutlmv3_startup [SAMPLE] [WEIGHTS]
+
+Prints the time to the first receipt and the RSS of a fresh process,
+OCR-only and with the transformer loaded as `__init__` used to. `WEIGHTS`
+is a local LayoutLMv3 model directory. By default a randomly initialized
+model of the base size is saved to a temporary directory, so the download
+and the processor files are left out.
+"""
+import subprocess
+import sys
+import tempfile
+
+# Run in a fresh interpreter: time to the first receipt and RSS, loading the
+# transformer from the given directory if any
+_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+from PIL import Image
+from modules.models.layoutlmv3 import LayoutLMv3ReceiptModel
+from modules.models.residency import current_rss
+model = LayoutLMv3ReceiptModel(use_layoutlm=False)
+if sys.argv[2]:
+    from transformers import LayoutLMv3Model
+    model._model = LayoutLMv3Model.from_pretrained(sys.argv[2]).eval()
+model.run(Image.open(sys.argv[1]).convert("RGB"))
+print(time.perf_counter() - start, current_rss())
+"""
+
+
+def main(sample: str = "receipt1.jpg", weights: str = "", repeat: int = 3) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        if not weights:
+            from transformers import LayoutLMv3Config, LayoutLMv3Model
+
+            weights = tmp
+            LayoutLMv3Model(LayoutLMv3Config()).save_pretrained(weights)
+        print("profile      first receipt      RSS")
+        for profile, path in (("ocr-only", ""), ("transformer", weights)):
+            runs = []
+            for _ in range(repeat):
+                output = subprocess.run(
+                    [sys.executable, "-c", _SCRIPT, sample, path],
+                    capture_output=True, text=True, check=True,
+                ).stdout.split()
+                runs.append((float(output[-2]), int(output[-1])))
+            seconds, rss = min(runs)
+            print(f"{profile:11}  {seconds:11.2f}s  {rss / 2**20:5.0f} MB")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
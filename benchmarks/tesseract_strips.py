@@ -0,0 +1,41 @@
+"""Measure OCR latency and words read against the strip count.
+
+Usage:
+    python -m benchmarks.tesseract_strips
+
+The page is a rendered receipt of `lines` item lines, about 40 pixels
+each. The words read should not change with the strip count, words in the
+overlaps being kept once.
+"""
+import os
+import time
+
+from PIL import Image, ImageDraw, ImageFont
+
+from modules.models.tesseract_pool import POOL_SIZE, image_to_data_tiled
+
+
+def main(lines: int = 300, repeat: int = 3) -> None:
+    font = ImageFont.load_default(size=28)
+    image = Image.new("L", (640, 40 * lines + 80), "white")
+    draw = ImageDraw.Draw(image)
+    for line in range(lines):
+        draw.text((30, 40 + 40 * line), f"ITEM {line:03d} NASI GORENG", fill="black", font=font)
+        draw.text((470, 40 + 40 * line), f"{(line + 1) * 1000:,}", fill="black", font=font)
+
+    print(f"{os.cpu_count()} cores, pool of {POOL_SIZE} engines, page {image.width}x{image.height}")
+    print("strips  seconds  speedup  words")
+    baseline = None
+    for strips in (1, 2, 4, 8):
+        seconds = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            data = image_to_data_tiled(image, strips)
+            seconds = min(seconds, time.perf_counter() - start)
+        baseline = baseline or seconds
+        words = sum(1 for text in data["text"] if text.strip())
+        print(f"{strips:6d}  {seconds:7.2f}  {baseline / seconds:6.2f}x  {words:5d}")
+
+
+if __name__ == "__main__":
+    main()
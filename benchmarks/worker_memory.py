@@ -0,0 +1,42 @@
+"""Measure the memory of the inference worker processes.
+
+Usage:
+    python -m benchmarks.worker_memory [MODEL_NAME] [SAMPLE]
+
+Prints the total PSS and the mean USS per worker of 1, 4 and 8 workers,
+spawned and preforked. Every worker reads receipts until it has loaded the
+model, the fork server holding the preloaded models is counted in prefork
+mode.
+"""
+import sys
+
+from modules.models.ingest import load_image
+from modules.models.residency import process_memory
+from modules.models.workers import InferenceService, RemoteModel
+
+
+def main(model_name: str = "Donut (int8 CPU)", sample: str = "receipt1.jpg") -> None:
+    image = load_image(sample)
+    print("mode     workers  total PSS  mean USS per worker")
+    for prefork in (False, True):
+        for workers in (1, 4, 8):
+            service = InferenceService(workers=workers, prefork=prefork)
+            service.start()
+            model = RemoteModel(service, model_name)
+            model.run_batch([image] * workers * 3)
+            memory = [process_memory(pid) for pid in service.pids()]
+            total = sum(pss for pss, _ in memory)
+            if service.prefork:
+                from multiprocessing import forkserver
+
+                total += process_memory(forkserver._forkserver._forkserver_pid)[0]
+            mean_unique = sum(uss for _, uss in memory) / len(memory)
+            print(
+                f"{'prefork' if service.prefork else 'spawn':8} {workers:7d}  "
+                f"{total / 2**20:7.0f} MB  {mean_unique / 2**20:7.0f} MB"
+            )
+            service.stop()
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
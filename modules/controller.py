@@ -9,7 +9,8 @@ import streamlit as st
 
 from .data import session_data
 from .data.report_data import ReportData
-from .models.loader import get_model
+from .models.loader import get_model, get_stage_names
+from .models.warmup import warmup
 from .utils import SettingsError
 from .views import (
     view_1_receipt_upload,
@@ -124,12 +125,18 @@ def view_2_done_func() -> None:
 
 def main_view() -> None:
     """Main page view."""
-    model = get_model()
+    # do not block on a model that is still loading in the background
+    warming = warmup.warming(get_stage_names(session_data.model_name.get()))
+    receipt_reader = None if warming else get_model().run_stream
     section_selection_view()
     current_page = session_data.current_page.get()
 
     page_options = {
-        1: functools.partial(view_1_receipt_upload.controller, model.run),
+        1: functools.partial(
+            view_1_receipt_upload.controller,
+            receipt_reader,
+            [name.value for name in warming],
+        ),
         2: view_2_assign_participants.controller,
         3: functools.partial(view_3_report.controller, session_data.report.get()),
     }
@@ -34,6 +34,15 @@ class ReceiptData:
 
     items: Dict[int, ItemData]
     total: float
+    # model (or cascade stage) that read the receipt and how long it took
+    source: str | None = None
+    read_seconds: float | None = None
+    # read by the fallback backend `source` because the requested model was
+    # unavailable, such readings are never cached
+    fallback: bool = False
+    # served by the extraction cache, `source` is the backend that first
+    # read it and `read_seconds` the time of the lookup
+    cached: bool = False
 
     @property
     def subtotal(self) -> float:
@@ -1,3 +1,4 @@
+import os
 from typing import Generic
 
 import streamlit as st
@@ -66,8 +67,16 @@ class SessionDataManager(Generic[T, V]):
 
 model = SessionDataManager[AIModel, type(None)]("model")
 model_name = SessionDataManager[ModelNames, ModelNames]("model_name", ModelNames.GEMINI)
+# local model currently reading receipts, differs from model_name while the
+# newly selected model loads
+serving_model_name = SessionDataManager[ModelNames, type(None)]("serving_model_name")
 currency = SessionDataManager[str, str]("currency", "IDR")
+gemini_api_key = SessionDataManager[str, type(None)](
+    "gemini_api_key", os.environ.get("GOOGLE_API_KEY")
+)
 image = SessionDataManager[Image.Image, type(None)]("image")
+image_file_id = SessionDataManager[str, type(None)]("image_file_id")
+receipt_quad = SessionDataManager[list, type(None)]("receipt_quad")
 receipt_data = SessionDataManager[ReceiptData, type(None)]("receipt_data")
 group_data = SessionDataManager[GroupData, GroupData]("group_data", GroupData())
 current_page = SessionDataManager[int, int]("current_page", 1)
@@ -88,6 +97,8 @@ def reset_receipt_data() -> None:
 def reset_app_state() -> None:
     """Reset the entire app state to start over."""
     image.reset()
+    image_file_id.reset()
+    receipt_quad.reset()
     receipt_data.reset()
     group_data.set(GroupData())
     split_manager.reset()
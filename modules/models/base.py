@@ -1,13 +1,44 @@
 from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Iterator
 
 from PIL import Image
 
-from modules.data.receipt_data import ReceiptData
+from modules.data.receipt_data import ItemData, ReceiptData
+
+from .ingest import fit_to_max_side
+
+
+@dataclass
+class ReadSignals:
+    """Quality signals a backend reports about one reading."""
+
+    # mean OCR word confidence, 0 to 1
+    ocr_confidence: float
+    # share of priced lines that could not be parsed, 0 to 1
+    parse_failure_rate: float
+    # whether the total was read from the receipt rather than derived from
+    # the items
+    total_read: bool = True
 
 
 class AIModel(ABC):
     "Base class of AI models"
 
+    # Longest image side the model makes use of, None for no limit
+    input_max_side: int | None = None
+
+    def fit_input(self, image: Image.Image) -> Image.Image:
+        """Downscale the image to the largest size this model uses.
+
+        Args:
+            image (Image.Image): the receipt photo image
+
+        Returns:
+            Image.Image: the image sized for this model
+        """
+        return fit_to_max_side(image, self.input_max_side)
+
     @abstractmethod
     def run(self, image: Image.Image) -> ReceiptData:
         """Retrieve data from the receipt.
@@ -18,4 +49,36 @@ class AIModel(ABC):
         Returns:
             ReceiptData: parsed receipt data
         """
-        pass
\ No newline at end of file
+        pass
+
+    def run_batch(self, images: list[Image.Image]) -> list[ReceiptData]:
+        """Retrieve data from several receipts at once.
+
+        Models that can process a batch natively should override this,
+        the default implementation simply calls `run` for each image.
+
+        Args:
+            images (list[Image.Image]): the receipt photo images
+
+        Returns:
+            list[ReceiptData]: parsed receipt data, in the same order
+                as the input images
+        """
+        return [self.run(image) for image in images]
+
+    def run_stream(self, image: Image.Image) -> Iterator[ItemData | ReceiptData]:
+        """Retrieve data from the receipt, yielding items as they are read.
+
+        Models that decode incrementally should override this, the default
+        implementation yields the items of `run` once it returns.
+
+        Args:
+            image (Image.Image): the receipt photo image
+
+        Yields:
+            ItemData | ReceiptData: each item as soon as it is read, then
+                the complete receipt data as the last value
+        """
+        receipt = self.run(image)
+        yield from receipt.items.values()
+        yield receipt
@@ -0,0 +1,142 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Iterator
+
+from PIL import Image
+
+from modules.data.receipt_data import ItemData, ReceiptData
+from .base import AIModel
+
+# Requests arriving within this many milliseconds of the first one share a
+# batch, 0 disables batching
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", "30"))
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "8"))
+# Seconds without requests after which the dispatcher thread exits, it is
+# started again by the next request
+DISPATCHER_IDLE_TIMEOUT = 2.0
+
+
+@dataclass
+class BatchStats:
+    """Counters on the batches run by a micro-batcher."""
+
+    batches: int = 0
+    requests: int = 0
+    # longest time a request waited for its batch to start, in seconds
+    max_wait: float = 0.0
+
+    @property
+    def mean_batch_size(self) -> float:
+        if self.batches == 0:
+            return 0.0
+        return self.requests / self.batches
+
+
+class MicroBatcher(AIModel):
+    """Runs concurrent requests of all sessions as batches of one model.
+
+    A dispatcher thread takes the first waiting request, collects the
+    others arriving within the window or until the batch is full, and runs
+    them with one `run_batch` call. Requests arriving meanwhile form the
+    next batch. A request alone waits at most the window. The dispatcher
+    exits when idle, so that it does not keep an evicted model alive.
+
+    Streaming is kept for a request arriving while the model is idle: it
+    runs directly with the model's `run_stream`.
+    """
+
+    def __init__(
+        self,
+        model: AIModel,
+        window_ms: float = BATCH_WINDOW_MS,
+        max_batch_size: int = MAX_BATCH_SIZE,
+    ) -> None:
+        """
+        Args:
+            model (AIModel): model with a native `run_batch`
+            window_ms (float, optional): collection window in milliseconds
+            max_batch_size (int, optional): largest batch run at once
+        """
+        self.model = model
+        self.input_max_side = model.input_max_side
+        self.window = window_ms / 1000
+        self.max_batch_size = max(max_batch_size, 1)
+        self.stats = BatchStats()
+        self._requests: queue.Queue[tuple[Image.Image, Future, float]] = queue.Queue()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._dispatcher: threading.Thread | None = None
+
+    def run(self, image: Image.Image) -> ReceiptData:
+        return self.run_batch([image])[0]
+
+    def run_batch(self, images: list[Image.Image]) -> list[ReceiptData]:
+        if self.window <= 0:
+            return self.model.run_batch(images)
+        futures = [self._submit(image) for image in images]
+        return [future.result() for future in futures]
+
+    def run_stream(self, image: Image.Image) -> Iterator[ItemData | ReceiptData]:
+        with self._lock:
+            idle = self._in_flight == 0
+            if idle:
+                self._in_flight += 1
+        if not idle:
+            yield from super().run_stream(image)
+            return
+        try:
+            yield from self.model.run_stream(image)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def _submit(self, image: Image.Image) -> Future:
+        future = Future()
+        with self._lock:
+            self._in_flight += 1
+            # under the lock, so an exiting dispatcher cannot miss it
+            self._requests.put((image, future, time.monotonic()))
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(
+                    target=self._dispatch, name="micro-batcher", daemon=True
+                )
+                self._dispatcher.start()
+        return future
+
+    def _dispatch(self) -> None:
+        while True:
+            try:
+                batch = [self._requests.get(timeout=DISPATCHER_IDLE_TIMEOUT)]
+            except queue.Empty:
+                with self._lock:
+                    if self._requests.empty():
+                        self._dispatcher = None
+                        return
+                continue
+            deadline = batch[0][2] + self.window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._requests.get(timeout=max(remaining, 0)))
+                except queue.Empty:
+                    break
+
+            start = time.monotonic()
+            self.stats.batches += 1
+            self.stats.requests += len(batch)
+            self.stats.max_wait = max(self.stats.max_wait, start - batch[0][2])
+            try:
+                results = self.model.run_batch([image for image, _, _ in batch])
+            except Exception as err:
+                for _, future, _ in batch:
+                    future.set_exception(err)
+            else:
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+            finally:
+                with self._lock:
+                    self._in_flight -= len(batch)
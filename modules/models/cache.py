@@ -0,0 +1,322 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import Iterator
+
+from PIL import Image
+
+from modules.data.receipt_data import ItemData, ReceiptData
+
+from .base import AIModel
+
+CACHE_DIR = os.getenv(
+    "EXTRACTION_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "smart-split-bill"),
+)
+CACHE_DB_FILE = "extraction_cache.sqlite3"
+MEMORY_LIMIT_BYTES = int(os.getenv("EXTRACTION_CACHE_MEMORY_MB", "16")) * 1024**2
+DISK_LIMIT_BYTES = int(os.getenv("EXTRACTION_CACHE_DISK_MB", "256")) * 1024**2
+# Maximum Hamming distance between perceptual hashes of two photos of the
+# same receipt, 0 disables perceptual matching.
+PHASH_MAX_DISTANCE = int(os.getenv("EXTRACTION_CACHE_PHASH_DISTANCE", "0"))
+
+
+@dataclass
+class CacheStats:
+    """Hit and miss counters of the extraction cache."""
+
+    memory_hits: int = 0
+    disk_hits: int = 0
+    perceptual_hits: int = 0
+    misses: int = 0
+
+    @property
+    def hits(self) -> int:
+        """Total number of hits across all tiers."""
+        return self.memory_hits + self.disk_hits + self.perceptual_hits
+
+
+class ExtractionCache:
+    """Two-tier cache of receipt extraction results.
+
+    Results are keyed on a hash of the normalized image pixels and the
+    model identity. The first tier is an in-process LRU bounded by the size
+    of the serialized results, the second tier is a SQLite file on disk
+    evicting the least recently used entries once it exceeds its size limit.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = CACHE_DIR,
+        memory_limit: int = MEMORY_LIMIT_BYTES,
+        disk_limit: int = DISK_LIMIT_BYTES,
+        phash_max_distance: int = PHASH_MAX_DISTANCE,
+    ) -> None:
+        """Create the cache, opening or creating the on-disk tier.
+
+        Args:
+            cache_dir (str, optional): directory of the SQLite file.
+            memory_limit (int, optional): in-process tier size in bytes.
+            disk_limit (int, optional): on-disk tier size in bytes.
+            phash_max_distance (int, optional): perceptual hash matching
+                distance, 0 disables it.
+        """
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.phash_max_distance = phash_max_distance
+        self.stats = CacheStats()
+
+        self._lock = threading.Lock()
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._memory_size = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._db = sqlite3.connect(
+            os.path.join(cache_dir, CACHE_DB_FILE), check_same_thread=False
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, model TEXT, phash INTEGER, "
+            "data BLOB, size INTEGER, last_access REAL)"
+        )
+        self._db.commit()
+        # perceptual hashes are few and small, keep them in memory for lookup
+        self._phashes: dict[str, tuple[str, int]] = {
+            key: (model, phash)
+            for key, model, phash in self._db.execute(
+                "SELECT key, model, phash FROM entries"
+            )
+        }
+
+    def get(self, model_key: str, image: Image.Image) -> ReceiptData | None:
+        """Look up the result of a model on an image.
+
+        Args:
+            model_key (str): model name and version
+            image (Image.Image): the receipt photo image
+
+        Returns:
+            ReceiptData | None: cached receipt data, marked as cached and
+                timed as the lookup, None on a miss
+        """
+        start = time.perf_counter()
+        key = image_key(model_key, image)
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.stats.memory_hits += 1
+                return _cache_hit(data, start)
+
+            data = self._disk_get(key)
+            if data is not None:
+                self.stats.disk_hits += 1
+                self._memory_put(key, data)
+                return _cache_hit(data, start)
+
+            if self.phash_max_distance > 0:
+                similar_key = self._find_similar(model_key, perceptual_hash(image))
+                data = self._disk_get(similar_key) if similar_key else None
+                if data is not None:
+                    self.stats.perceptual_hits += 1
+                    self._memory_put(key, data)
+                    return _cache_hit(data, start)
+
+            self.stats.misses += 1
+            return None
+
+    def put(self, model_key: str, image: Image.Image, receipt: ReceiptData) -> None:
+        """Store the result of a model on an image.
+
+        Fallback readings are not stored, the model's own reading is
+        wanted once it is available again.
+
+        Args:
+            model_key (str): model name and version
+            image (Image.Image): the receipt photo image
+            receipt (ReceiptData): the model result
+        """
+        if receipt.fallback:
+            return
+        key = image_key(model_key, image)
+        phash = perceptual_hash(image)
+        data = _serialize(receipt)
+        with self._lock:
+            self._memory_put(key, data)
+            self._disk_put(key, model_key, phash, data)
+
+    def _memory_put(self, key: str, data: bytes) -> None:
+        if key in self._memory:
+            self._memory_size -= len(self._memory.pop(key))
+        self._memory[key] = data
+        self._memory_size += len(data)
+        while self._memory_size > self.memory_limit and self._memory:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def _disk_get(self, key: str) -> bytes | None:
+        row = self._db.execute(
+            "SELECT data FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        self._db.execute(
+            "UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key)
+        )
+        self._db.commit()
+        return row[0]
+
+    def _disk_put(self, key: str, model_key: str, phash: int, data: bytes) -> None:
+        # SQLite integers are signed 64 bit
+        signed_phash = phash - (1 << 64) if phash >= (1 << 63) else phash
+        self._db.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+            (key, model_key, signed_phash, data, len(data), time.time()),
+        )
+        self._phashes[key] = (model_key, signed_phash)
+
+        (total_size,) = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+        while total_size > self.disk_limit:
+            row = self._db.execute(
+                "SELECT key, size FROM entries ORDER BY last_access LIMIT 1"
+            ).fetchone()
+            if row is None:
+                break
+            self._db.execute("DELETE FROM entries WHERE key = ?", (row[0],))
+            self._phashes.pop(row[0], None)
+            total_size -= row[1]
+        self._db.commit()
+
+    def _find_similar(self, model_key: str, phash: int) -> str | None:
+        best_key, best_distance = None, self.phash_max_distance + 1
+        for key, (model, other) in self._phashes.items():
+            if model != model_key:
+                continue
+            distance = bin((phash ^ other) & ((1 << 64) - 1)).count("1")
+            if distance < best_distance:
+                best_key, best_distance = key, distance
+        return best_key
+
+
+class CachedModel(AIModel):
+    """AI model wrapper that serves repeated receipts from the cache.
+
+    Images are first downscaled to the size the wrapped model uses, which
+    also makes hashing them cheaper.
+    """
+
+    def __init__(self, model: AIModel, model_key: str, cache: ExtractionCache) -> None:
+        """Wrap a model with the extraction cache.
+
+        Args:
+            model (AIModel): the wrapped model
+            model_key (str): model name and version, part of the cache key
+            cache (ExtractionCache): the shared cache
+        """
+        self.model = model
+        self.model_key = model_key
+        self.cache = cache
+
+    def run(self, image: Image.Image) -> ReceiptData:
+        image = self.model.fit_input(image)
+        receipt = self.cache.get(self.model_key, image)
+        if receipt is None:
+            receipt = self.model.run(image)
+            self.cache.put(self.model_key, image, receipt)
+        return receipt
+
+    def run_batch(self, images: list[Image.Image]) -> list[ReceiptData]:
+        images = [self.model.fit_input(image) for image in images]
+        results = [self.cache.get(self.model_key, image) for image in images]
+        missing = [i for i, receipt in enumerate(results) if receipt is None]
+        if missing:
+            receipts = self.model.run_batch([images[i] for i in missing])
+            for i, receipt in zip(missing, receipts):
+                self.cache.put(self.model_key, images[i], receipt)
+                results[i] = receipt
+        return results
+
+    def run_stream(self, image: Image.Image) -> Iterator[ItemData | ReceiptData]:
+        image = self.model.fit_input(image)
+        receipt = self.cache.get(self.model_key, image)
+        if receipt is not None:
+            yield from receipt.items.values()
+            yield receipt
+            return
+        for result in self.model.run_stream(image):
+            if isinstance(result, ReceiptData):
+                self.cache.put(self.model_key, image, result)
+            yield result
+
+
+def image_key(model_key: str, image: Image.Image) -> str:
+    """Content hash of the normalized image pixels and the model identity.
+
+    Args:
+        model_key (str): model name and version
+        image (Image.Image): the receipt photo image
+
+    Returns:
+        str: hex digest
+    """
+    normalized = image.convert("RGB")
+    digest = hashlib.sha256(model_key.encode())
+    digest.update(f"{normalized.width}x{normalized.height}".encode())
+    digest.update(normalized.tobytes())
+    return digest.hexdigest()
+
+
+def perceptual_hash(image: Image.Image) -> int:
+    """64 bit difference hash, robust to re-encoding and small changes.
+
+    Args:
+        image (Image.Image): the receipt photo image
+
+    Returns:
+        int: the hash
+    """
+    pixels = list(image.convert("L").resize((9, 8), Image.BILINEAR).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def _serialize(receipt: ReceiptData) -> bytes:
+    items = [
+        {"name": it.name, "count": it.count, "total_price": it.total_price}
+        for it in receipt.items.values()
+    ]
+    return json.dumps({
+        "items": items,
+        "total": receipt.total,
+        "source": receipt.source,
+        "read_seconds": receipt.read_seconds,
+    }).encode()
+
+
+def _cache_hit(data: bytes, start: float) -> ReceiptData:
+    return replace(
+        _deserialize(data), cached=True, read_seconds=time.perf_counter() - start
+    )
+
+
+def _deserialize(data: bytes) -> ReceiptData:
+    dict_data = json.loads(data)
+    items = [ItemData(**item) for item in dict_data["items"]]
+    return ReceiptData(
+        items={it.id: it for it in items},
+        total=dict_data["total"],
+        source=dict_data.get("source"),
+        read_seconds=dict_data.get("read_seconds"),
+    )
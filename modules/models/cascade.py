@@ -0,0 +1,180 @@
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, replace
+from typing import Callable
+
+from PIL import Image
+
+from modules.data.receipt_data import ReceiptData
+from .base import AIModel, ReadSignals
+
+logger = logging.getLogger(__name__)
+
+# Readings scoring at least this much are kept without escalating
+CONFIDENCE_THRESHOLD = float(os.getenv("CASCADE_CONFIDENCE_THRESHOLD", "0.7"))
+# Relative gap between the total and the item sum that scores zero, taxes
+# and service charges make small gaps normal
+RECONCILE_TOLERANCE = 0.3
+
+SCORE_WEIGHTS = {"reconcile": 0.5, "parse": 0.25, "ocr": 0.25}
+
+# Threads running the race stages of all sessions
+RACE_THREADS = int(os.getenv("RACE_THREADS", "16"))
+
+_race_executor = ThreadPoolExecutor(max_workers=RACE_THREADS, thread_name_prefix="race")
+
+
+def reconcile_score(receipt: ReceiptData, signals: ReadSignals | None = None) -> float:
+    """How well the item sum matches the receipt total.
+
+    Args:
+        receipt (ReceiptData): parsed receipt data
+        signals (ReadSignals | None, optional): backend quality signals
+
+    Returns:
+        float: 1 when they match, down to 0 at a relative gap of
+            RECONCILE_TOLERANCE, when there are no items or when the
+            backend did not read the total
+    """
+    if signals is not None and not signals.total_read:
+        # a total derived from the items reconciles by construction
+        return 0.0
+    if not receipt.items or receipt.total <= 0:
+        return 0.0
+    gap = abs(receipt.total - receipt.subtotal) / receipt.total
+    return max(0.0, 1.0 - gap / RECONCILE_TOLERANCE)
+
+
+def confidence(receipt: ReceiptData, signals: ReadSignals | None = None) -> float:
+    """Score a reading between 0 and 1.
+
+    Args:
+        receipt (ReceiptData): parsed receipt data
+        signals (ReadSignals | None, optional): backend quality signals,
+            without them only the reconciliation of the total counts
+
+    Returns:
+        float: confidence score
+    """
+    reconcile = reconcile_score(receipt, signals)
+    if signals is None:
+        return reconcile
+    return (
+        SCORE_WEIGHTS["reconcile"] * reconcile
+        + SCORE_WEIGHTS["parse"] * (1.0 - signals.parse_failure_rate)
+        + SCORE_WEIGHTS["ocr"] * signals.ocr_confidence
+    )
+
+
+def is_valid(receipt: ReceiptData, signals: ReadSignals | None = None) -> bool:
+    """Whether a reading is plausible: it has items reconciling with a total
+    read from the receipt."""
+    return reconcile_score(receipt, signals) > 0.0
+
+
+@dataclass
+class Stage:
+    """A backend of the cascade, loaded on first use."""
+
+    name: str
+    load: Callable[[], AIModel]
+
+    def run(self, image: Image.Image) -> tuple[ReceiptData, ReadSignals | None]:
+        """Read the receipt, recording this stage and its time on the result.
+
+        Returns:
+            tuple[ReceiptData, ReadSignals | None]: the receipt data and the
+                backend quality signals, None if it reports none
+        """
+        start = time.perf_counter()
+        model = self.load()
+        run_with_signals = getattr(model, "run_with_signals", None)
+        if run_with_signals is not None:
+            receipt, signals = run_with_signals(image)
+        else:
+            receipt, signals = model.run(image), None
+        receipt = replace(
+            receipt,
+            # a fallback reading keeps the name of the backend that read it
+            source=receipt.source if receipt.fallback else self.name,
+            read_seconds=time.perf_counter() - start,
+        )
+        return receipt, signals
+
+
+class CascadeModel(AIModel):
+    """Reads receipts with the cheapest backend that is confident enough.
+
+    In "cascade" mode stages run one after the other, in order, until one
+    scores at least the threshold, the last stage answers regardless. In
+    "race" mode all stages run concurrently, on threads shared by all
+    sessions, and the first valid reading is kept, the most confident one
+    if none is valid.
+    """
+
+    def __init__(
+        self,
+        stages: list[Stage],
+        mode: str = "cascade",
+        threshold: float = CONFIDENCE_THRESHOLD,
+    ) -> None:
+        """
+        Args:
+            stages (list[Stage]): backends, cheapest first
+            mode (str, optional): "cascade" or "race". Defaults to "cascade".
+            threshold (float, optional): confidence needed to stop the
+                cascade
+        """
+        if mode not in ("cascade", "race"):
+            raise ValueError(f"Unknown cascade mode: {mode}")
+        self.stages = stages
+        self.mode = mode
+        self.threshold = threshold
+
+    def run(self, image: Image.Image) -> ReceiptData:
+        if self.mode == "race":
+            return self._race(image)
+        return self._cascade(image)
+
+    def _cascade(self, image: Image.Image) -> ReceiptData:
+        start = time.perf_counter()
+        for index, stage in enumerate(self.stages):
+            receipt, signals = stage.run(image)
+            score = confidence(receipt, signals)
+            logger.info(
+                "Cascade stage %s scored %.2f in %.2fs",
+                stage.name,
+                score,
+                receipt.read_seconds,
+            )
+            if score >= self.threshold or index == len(self.stages) - 1:
+                return replace(receipt, read_seconds=time.perf_counter() - start)
+        raise ValueError("Cascade has no stages")
+
+    def _race(self, image: Image.Image) -> ReceiptData:
+        start = time.perf_counter()
+        pending = {_race_executor.submit(stage.run, image) for stage in self.stages}
+        best: tuple[ReceiptData, float] | None = None
+        error: Exception | None = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    receipt, signals = future.result()
+                except Exception as err:
+                    error = err
+                    continue
+                if is_valid(receipt, signals):
+                    # slower stages finish in the background, their result
+                    # is dropped
+                    for other in pending:
+                        other.cancel()
+                    return replace(receipt, read_seconds=time.perf_counter() - start)
+                score = confidence(receipt, signals)
+                if best is None or score > best[1]:
+                    best = (receipt, score)
+        if best is None:
+            raise error
+        return replace(best[0], read_seconds=time.perf_counter() - start)
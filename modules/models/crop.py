@@ -0,0 +1,151 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+# Warp the detected quadrilateral to a rectangle instead of a plain crop
+PERSPECTIVE_CORRECTION = os.getenv("AUTO_CROP_PERSPECTIVE", "1") == "1"
+# Side of the downscaled copy the detection runs on
+DETECTION_SIZE = 256
+# Detections covering less or more of the photo than this are ignored
+MIN_AREA_FRACTION = 0.1
+MAX_AREA_FRACTION = 0.9
+
+Quad = list[tuple[float, float]]
+
+
+def detect_receipt(image: Image.Image) -> Quad | None:
+    """Find the quadrilateral of the receipt paper in a photo.
+
+    Paper is bright and unsaturated, pixels are scored on that and split
+    with Otsu's threshold on a small copy of the photo. The paper's left and
+    right borders are fitted as lines over its rows, top and bottom borders
+    over its columns, and their intersections give the corners.
+
+    Args:
+        image (Image.Image): the receipt photo image
+
+    Returns:
+        Quad | None: corners as top-left, top-right, bottom-right,
+            bottom-left in image pixels, None if no receipt stands out from
+            the background
+    """
+    small = image.convert("RGB")
+    small.thumbnail((DETECTION_SIZE, DETECTION_SIZE))
+    pixels = np.asarray(small, dtype=float)
+    saturation = pixels.max(axis=2) - pixels.min(axis=2)
+    score = pixels.mean(axis=2) - 1.5 * saturation
+    mask = _box_smooth(score > _otsu_threshold(score), 5) > 0.5
+    if not mask.any():
+        return None
+
+    rows = np.flatnonzero(mask.mean(axis=1) > 0.1)
+    cols = np.flatnonzero(mask.mean(axis=0) > 0.1)
+    if len(rows) < 2 or len(cols) < 2:
+        return None
+    row_mask = mask[rows]
+    col_mask = mask[:, cols]
+
+    left = _fit_line(rows, row_mask.argmax(axis=1))
+    right = _fit_line(rows, mask.shape[1] - 1 - row_mask[:, ::-1].argmax(axis=1))
+    top = _fit_line(cols, col_mask.argmax(axis=0))
+    bottom = _fit_line(cols, mask.shape[0] - 1 - col_mask[::-1].argmax(axis=0))
+
+    scale_x = image.width / mask.shape[1]
+    scale_y = image.height / mask.shape[0]
+    quad = []
+    for vertical, horizontal in ((left, top), (right, top), (right, bottom), (left, bottom)):
+        x, y = _intersect(vertical, horizontal)
+        quad.append((
+            float(np.clip(x * scale_x, 0, image.width)),
+            float(np.clip(y * scale_y, 0, image.height)),
+        ))
+
+    area = _polygon_area(quad) / (image.width * image.height)
+    if not MIN_AREA_FRACTION <= area <= MAX_AREA_FRACTION:
+        return None
+    return quad
+
+
+def crop_receipt(
+    image: Image.Image, quad: Quad | None, perspective: bool = PERSPECTIVE_CORRECTION
+) -> Image.Image:
+    """Crop the photo to the detected receipt.
+
+    Args:
+        image (Image.Image): the receipt photo image
+        quad (Quad | None): receipt corners from `detect_receipt`, None
+            keeps the whole photo
+        perspective (bool, optional): warp the quadrilateral to a rectangle,
+            otherwise crop its bounding box
+
+    Returns:
+        Image.Image: the receipt image
+    """
+    if quad is None:
+        return image
+    (tl, tr, br, bl) = quad
+    if not perspective:
+        xs = [x for x, _ in quad]
+        ys = [y for _, y in quad]
+        return image.crop((int(min(xs)), int(min(ys)), int(max(xs)), int(max(ys))))
+
+    width = int(max(np.hypot(tr[0] - tl[0], tr[1] - tl[1]), np.hypot(br[0] - bl[0], br[1] - bl[1])))
+    height = int(max(np.hypot(bl[0] - tl[0], bl[1] - tl[1]), np.hypot(br[0] - tr[0], br[1] - tr[1])))
+    # QUAD data order is upper left, lower left, lower right, upper right
+    data = (*tl, *bl, *br, *tr)
+    return image.transform(
+        (max(width, 1), max(height, 1)), Image.Transform.QUAD, data, Image.Resampling.BILINEAR
+    )
+
+
+def _otsu_threshold(values: np.ndarray) -> float:
+    hist, edges = np.histogram(values, bins=256)
+    centers = (edges[:-1] + edges[1:]) / 2
+    weight_low = np.cumsum(hist)
+    weight_high = weight_low[-1] - weight_low
+    sum_low = np.cumsum(hist * centers)
+    mean_low = sum_low / np.maximum(weight_low, 1)
+    mean_high = (sum_low[-1] - sum_low) / np.maximum(weight_high, 1)
+    between = weight_low * weight_high * (mean_low - mean_high) ** 2
+    return float(centers[between.argmax()])
+
+
+def _box_smooth(mask: np.ndarray, size: int) -> np.ndarray:
+    half = size // 2
+    padded = np.pad(mask.astype(float), half + 1, mode="edge")
+    integral = padded.cumsum(0).cumsum(1)
+    height, width = mask.shape
+    top, left = np.ogrid[0:height, 0:width]
+    bottom, right = top + size, left + size
+    window = (
+        integral[bottom, right]
+        - integral[top, right]
+        - integral[bottom, left]
+        + integral[top, left]
+    )
+    return window / (size * size)
+
+
+def _fit_line(positions: np.ndarray, borders: np.ndarray) -> tuple[float, float]:
+    """Fit border = slope * position + offset, ignoring outlying borders."""
+    deviation = np.abs(borders - np.median(borders))
+    inliers = deviation <= max(2.5 * np.median(deviation), 2.0)
+    if inliers.sum() < 2:
+        return 0.0, float(np.median(borders))
+    slope, offset = np.polyfit(positions[inliers], borders[inliers], 1)
+    return float(slope), float(offset)
+
+
+def _intersect(vertical: tuple[float, float], horizontal: tuple[float, float]) -> tuple[float, float]:
+    # vertical: x = a * y + b, horizontal: y = c * x + d
+    a, b = vertical
+    c, d = horizontal
+    x = (a * d + b) / (1 - a * c)
+    return x, c * x + d
+
+
+def _polygon_area(quad: Quad) -> float:
+    xs = np.array([x for x, _ in quad])
+    ys = np.array([y for _, y in quad])
+    return float(abs(np.dot(xs, np.roll(ys, 1)) - np.dot(ys, np.roll(xs, 1))) / 2)
@@ -1,17 +1,51 @@
 # gemini.py
 import base64
+import hashlib
 import json
+import logging
+import math
 import os
+import threading
+import time
+from dataclasses import replace
 from io import BytesIO
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Iterator
 
 from PIL import Image
 
 from modules.data.receipt_data import ItemData, ReceiptData
 from modules.utils import AIError, SettingsError
 from .base import AIModel
+from .gemini_client import AsyncGeminiClient
+from .ingest import fit_to_max_side
+from .rate_limit import CircuitOpenError
+
+logger = logging.getLogger(__name__)
 
 MODEL_NAME = "gemini-2.5-flash"
+# Use an offline fake of the API, for load testing
+USE_FAKE_API = os.getenv("GEMINI_FAKE_API", "0") == "1"
+# Ask the API for JSON following RESPONSE_SCHEMA instead of parsing free text
+STRUCTURED_OUTPUT = os.getenv("GEMINI_STRUCTURED_OUTPUT", "0") == "1"
+# Pooled clients unused for this many seconds are dropped
+CLIENT_IDLE_TTL = float(os.getenv("GEMINI_CLIENT_IDLE_TTL", "900"))
+# Local backend (a ModelNames value) used while the circuit breaker is
+# open, empty to fail fast instead
+FALLBACK_MODEL = os.getenv("GEMINI_FALLBACK_MODEL", "Tesseract (OCR only)")
+
+# Token accounting of the API: 258 tokens per 768x768 image tile
+IMAGE_TILE_SIZE = 768
+TOKENS_PER_TILE = 258
+PROMPT_TOKENS = 200
+RESPONSE_TOKENS = 500
+
+# Image encoding sent to the API
+IMAGE_FORMAT = os.getenv("GEMINI_IMAGE_FORMAT", "JPEG").upper()
+IMAGE_QUALITY = 85
+IMAGE_MIN_QUALITY = 55
+IMAGE_MIN_SIDE = 768
+IMAGE_BYTE_BUDGET = int(os.getenv("GEMINI_IMAGE_BYTE_BUDGET", str(400 * 1024)))
+MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
 
 PROMPT = """
 You are given an image of a receipt. Please read the content into JSON format:
@@ -30,13 +64,50 @@ You are given an image of a receipt. Please read the content into JSON format:
 Return only JSON.
 """
 
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "menus": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string"},
+                    "count": {"type": "integer"},
+                    "price": {"type": "number"},
+                },
+                "required": ["name", "price"],
+                "propertyOrdering": ["name", "count", "price"],
+            },
+        },
+        "total": {"type": "number"},
+    },
+    "required": ["menus", "total"],
+    # items first, so that they can be streamed before the total
+    "propertyOrdering": ["menus", "total"],
+}
+
 
 class GeminiModel(AIModel):
     """Receipt reader based on Gemini model API.
     This module is SAFE: it will only require langchain if you really use GeminiModel.
     """
 
-    def __init__(self) -> None:
+    # the API downsizes larger images before tokenizing them
+    input_max_side = 3072
+
+    def __init__(
+        self, api_key: str | None = None, structured: bool = STRUCTURED_OUTPUT
+    ) -> None:
+        """
+        Args:
+            api_key (str | None, optional): Google API key used by this
+                model's client, passed explicitly rather than through the
+                environment. Defaults to None.
+            structured (bool, optional): request JSON constrained to
+                RESPONSE_SCHEMA, so the response needs no cleanup
+        """
+        self.structured = structured
         try:
             from langchain_core.messages import HumanMessage
             from langchain_google_genai import ChatGoogleGenerativeAI
@@ -46,26 +117,103 @@ class GeminiModel(AIModel):
                 "pip install langchain-core langchain-google-genai"
             ) from e
 
-        if "GOOGLE_API_KEY" not in os.environ or os.environ["GOOGLE_API_KEY"] == "":
-            raise SettingsError("GOOGLE_API_KEY not set.")
-
         self.HumanMessage = HumanMessage
-        self.llm = ChatGoogleGenerativeAI(model=MODEL_NAME, temperature=0.0)
+        if USE_FAKE_API:
+            from benchmarks.fake_gemini import FakeGeminiLLM
+
+            self.llm = FakeGeminiLLM()
+        else:
+            if not api_key:
+                raise SettingsError("GOOGLE_API_KEY not set.")
+            # the client keeps its own connection, reused by every call
+            schema_kwargs = (
+                {"response_mime_type": "application/json", "response_schema": RESPONSE_SCHEMA}
+                if structured
+                else {}
+            )
+            self.llm = ChatGoogleGenerativeAI(
+                model=MODEL_NAME, temperature=0.0, google_api_key=api_key, **schema_kwargs
+            )
+        self.client = AsyncGeminiClient(self.llm)
 
     def run(self, image: Image.Image) -> ReceiptData:
-        image_b64 = self._encode_image(image)
+        return self.run_batch([image])[0]
+
+    def run_batch(self, images: list[Image.Image]) -> list[ReceiptData]:
+        # all requests are in flight together, bounded by the client limits
+        futures = [self.client.submit(*self._build_request(image)) for image in images]
+        try:
+            return [self._to_receipt(future.result()) for future in futures]
+        except CircuitOpenError:
+            if not FALLBACK_MODEL:
+                raise
+            from .loader import ModelNames, load_model_cached
+
+            receipts = load_model_cached(ModelNames(FALLBACK_MODEL)).run_batch(images)
+            return [_as_fallback(receipt) for receipt in receipts]
+
+    def run_stream(self, image: Image.Image) -> Iterator[ItemData | ReceiptData]:
+        """Read the receipt, yielding each item as soon as the API sends it.
+
+        The response is streamed and its `menus` array parsed incrementally,
+        the whole response is parsed again at the end for the total.
+
+        Args:
+            image (Image.Image): the receipt photo image
+
+        Yields:
+            ItemData | ReceiptData: each item once its JSON object closes,
+                then the complete receipt data as the last value
+        """
+        _, messages, estimated_tokens = self._build_request(image)
+        parser = _MenuStreamParser()
+        try:
+            for chunk in self.client.stream(messages, estimated_tokens):
+                yield from parser.feed(chunk)
+        except CircuitOpenError:
+            if not FALLBACK_MODEL or parser.items:
+                raise
+            from .loader import ModelNames, load_model_cached
+
+            for result in load_model_cached(ModelNames(FALLBACK_MODEL)).run_stream(image):
+                yield _as_fallback(result) if isinstance(result, ReceiptData) else result
+            return
+
+        receipt = self._to_receipt(parser.text)
+        if len(receipt.items) == len(parser.items):
+            # keep the ids of the items already shown
+            receipt = ReceiptData(
+                items={item.id: item for item in parser.items}, total=receipt.total
+            )
+        yield receipt
+
+    def _build_request(self, image: Image.Image) -> tuple[str, list, int]:
+        """Build the chat messages, coalescing key and token estimate.
+
+        Args:
+            image (Image.Image): the receipt photo image
+
+        Returns:
+            tuple[str, list, int]: hash of the encoded image, the messages
+                and the estimated number of tokens of the call
+        """
+        image_b64, mime_type, (width, height) = self._encode_image(image)
+        tiles = math.ceil(width / IMAGE_TILE_SIZE) * math.ceil(height / IMAGE_TILE_SIZE)
+        estimated_tokens = PROMPT_TOKENS + RESPONSE_TOKENS + TOKENS_PER_TILE * tiles
 
         message = self.HumanMessage(
             content=[
                 {"type": "text", "text": PROMPT},
                 {
                     "type": "image_url",
-                    "image_url": f"data:image/png;base64,{image_b64}",
+                    "image_url": f"data:{mime_type};base64,{image_b64}",
                 },
             ]
         )
+        key = hashlib.sha256(image_b64.encode()).hexdigest()
+        return key, [message], estimated_tokens
 
-        response = self.llm.invoke([message]).content
+    def _to_receipt(self, response) -> ReceiptData:
         if not isinstance(response, str):
             raise AIError(f"Gemini response invalid: {response}")
 
@@ -74,10 +222,47 @@ class GeminiModel(AIModel):
         except Exception as err:
             raise AIError(f"Unable to parse Gemini response: {response}") from err
 
-    def _encode_image(self, image: Image.Image) -> str:
-        buffer = BytesIO()
-        image.save(buffer, format="PNG")
-        return base64.b64encode(buffer.getvalue()).decode("utf-8")
+    def _encode_image(self, image: Image.Image) -> tuple[str, str, tuple[int, int]]:
+        """Encode the image compactly for the API request.
+
+        The image is downscaled to the largest size the API uses and saved
+        as lossy JPEG/WebP. Quality, then resolution, is lowered until the
+        payload fits the byte budget.
+
+        Args:
+            image (Image.Image): the receipt photo image
+
+        Returns:
+            tuple[str, str, tuple[int, int]]: base64 encoded image, its MIME
+                type and its size
+        """
+        start = time.perf_counter()
+        image = fit_to_max_side(image.convert("RGB"), self.input_max_side)
+        quality = IMAGE_QUALITY
+        while True:
+            buffer = BytesIO()
+            image.save(buffer, format=IMAGE_FORMAT, quality=quality)
+            if buffer.tell() <= IMAGE_BYTE_BUDGET:
+                break
+            if quality > IMAGE_MIN_QUALITY:
+                quality -= 10
+            elif max(image.size) > IMAGE_MIN_SIDE:
+                image = fit_to_max_side(image, int(max(image.size) * 0.75))
+            else:
+                break
+
+        data = buffer.getvalue()
+        logger.info(
+            "Gemini image payload: %s %dx%d q=%d, %d bytes, encoded in %.1f ms",
+            IMAGE_FORMAT,
+            image.width,
+            image.height,
+            quality,
+            len(data),
+            (time.perf_counter() - start) * 1000,
+        )
+        encoded = base64.b64encode(data).decode("utf-8")
+        return encoded, MIME_TYPES[IMAGE_FORMAT], image.size
 
     def _format_response(self, response: str) -> ReceiptData:
         dict_data = self._parse_response_to_dict(response)
@@ -85,17 +270,137 @@ class GeminiModel(AIModel):
         total = float(dict_data["total"])
         menus_list = dict_data["menus"]
 
-        items = [
-            ItemData(
-                name=str(item["name"]),
-                count=int(item.get("count", 1)),
-                total_price=float(item["price"]),
-            )
-            for item in menus_list
-        ]
+        items = [_to_item(item) for item in menus_list]
 
         return ReceiptData(items={it.id: it for it in items}, total=total)
 
     def _parse_response_to_dict(self, response: str) -> dict:
+        if self.structured:
+            return json.loads(response)
         clean_json_str = response.replace("```json", "").replace("```", "")
         return json.loads(clean_json_str)
+
+
+def _as_fallback(receipt: ReceiptData) -> ReceiptData:
+    """Label a reading of the fallback backend, keeping it out of the cache."""
+    return replace(receipt, source=FALLBACK_MODEL, fallback=True)
+
+
+def _to_item(item: dict) -> ItemData:
+    return ItemData(
+        name=str(item["name"]),
+        count=int(item.get("count", 1)),
+        total_price=float(item["price"]),
+    )
+
+
+class _MenuStreamParser:
+    """Incremental parser of the `menus` array of a streamed JSON response.
+
+    Characters are scanned once as they arrive, tracking nesting depth and
+    strings. Each object directly inside the `menus` array is decoded as
+    soon as its closing brace arrives. Text around the JSON, such as code
+    fences, contains no braces or quotes and is skipped by the scan.
+    """
+
+    def __init__(self) -> None:
+        self.text = ""
+        self.items: list[ItemData] = []
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.string_start = 0
+        self.last_string: str | None = None
+        # depth inside the menus array, and start of the current item
+        self.menus_depth: int | None = None
+        self.item_start: int | None = None
+
+    def feed(self, chunk: str) -> list[ItemData]:
+        """Add response text and return the items it completed.
+
+        Args:
+            chunk (str): newly received text
+
+        Returns:
+            list[ItemData]: items completed by this text
+        """
+        self.text += chunk
+        completed = []
+        text = self.text
+        for pos in range(self.pos, len(text)):
+            char = text[pos]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    self.last_string = text[self.string_start + 1:pos]
+            elif char == '"':
+                self.in_string = True
+                self.string_start = pos
+            elif char in "{[":
+                self.depth += 1
+                if char == "[" and self.depth == 2 and self.last_string == "menus":
+                    self.menus_depth = self.depth
+                elif char == "{" and self.menus_depth == self.depth - 1:
+                    self.item_start = pos
+            elif char in "}]":
+                if char == "}" and self.item_start is not None and self.menus_depth == self.depth - 1:
+                    item = self._decode_item(text[self.item_start:pos + 1])
+                    if item is not None:
+                        completed.append(item)
+                    self.item_start = None
+                elif char == "]" and self.menus_depth == self.depth:
+                    self.menus_depth = None
+                self.depth -= 1
+        self.pos = len(text)
+        self.items.extend(completed)
+        return completed
+
+    def _decode_item(self, item_json: str) -> ItemData | None:
+        try:
+            return _to_item(json.loads(item_json))
+        except (ValueError, KeyError, TypeError):
+            # the final parse of the whole response decides
+            logger.debug("Skipping unreadable streamed item: %s", item_json)
+            return None
+
+
+class GeminiModelPool:
+    """Gemini models, one per API key, shared by the sessions using that key.
+
+    Models are keyed by a hash of the key so the key itself is not kept as
+    a dictionary key, and are dropped once unused for `idle_ttl` seconds.
+    """
+
+    def __init__(self, idle_ttl: float = CLIENT_IDLE_TTL) -> None:
+        self.idle_ttl = idle_ttl
+        self._models: dict[str, tuple[GeminiModel, float]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, api_key: str | None) -> GeminiModel:
+        """Get the model of an API key, creating it if needed.
+
+        Args:
+            api_key (str | None): Google API key
+
+        Returns:
+            GeminiModel: model calling the API with this key
+        """
+        key_hash = hashlib.sha256((api_key or "").encode()).hexdigest()
+        now = time.monotonic()
+        with self._lock:
+            for other_hash, (_, last_used) in list(self._models.items()):
+                if now - last_used > self.idle_ttl:
+                    del self._models[other_hash]
+
+            entry = self._models.get(key_hash)
+            model = entry[0] if entry is not None else GeminiModel(api_key)
+            self._models[key_hash] = (model, now)
+            return model
+
+    def __len__(self) -> int:
+        return len(self._models)
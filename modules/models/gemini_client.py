@@ -0,0 +1,261 @@
+import asyncio
+import os
+import queue
+import random
+import threading
+from concurrent.futures import Future
+from typing import Any, AsyncIterator, Iterator
+
+from modules.utils import AIError
+
+from .rate_limit import GeminiLimiter, gemini_limiter
+
+MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "3"))
+# Deadline of a single API call, in seconds
+CALL_TIMEOUT = float(os.getenv("GEMINI_CALL_TIMEOUT", "60"))
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 20.0
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+RETRYABLE_ERROR_NAMES = {
+    "ResourceExhausted",
+    "ServiceUnavailable",
+    "InternalServerError",
+    "DeadlineExceeded",
+    "TooManyRequests",
+    "TimeoutError",
+}
+
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_lock = threading.Lock()
+# shared by every client, it binds to the client loop on first use
+_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Get the process-wide event loop running Gemini calls.
+
+    The loop runs on a daemon thread so that the synchronous Streamlit
+    script threads of all sessions can submit calls to it.
+
+    Returns:
+        asyncio.AbstractEventLoop: the running loop
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_loop.run_forever, name="gemini-client", daemon=True
+            ).start()
+        return _loop
+
+
+def is_retryable(err: BaseException) -> bool:
+    """Whether a failed call is worth retrying (rate limit, 5xx, timeout).
+
+    Args:
+        err (BaseException): the raised error
+
+    Returns:
+        bool: True if retryable
+    """
+    if isinstance(err, asyncio.TimeoutError):
+        return True
+    for candidate in (err, err.__cause__):
+        if candidate is None:
+            continue
+        if type(candidate).__name__ in RETRYABLE_ERROR_NAMES:
+            return True
+        code = getattr(candidate, "code", None)
+        code = getattr(code, "value", code)
+        if isinstance(code, int) and code in RETRYABLE_STATUS_CODES:
+            return True
+    return False
+
+
+class AsyncGeminiClient:
+    """Concurrency limited, retrying and coalescing caller of a chat model.
+
+    All calls of all clients go through one process-wide semaphore.
+    Retryable errors are retried with exponential backoff and full jitter,
+    each attempt has its own deadline. Calls with the same key made while
+    one is in flight share its result instead of calling the API again.
+    """
+
+    def __init__(
+        self,
+        llm: Any,
+        max_retries: int = MAX_RETRIES,
+        call_timeout: float = CALL_TIMEOUT,
+        limiter: GeminiLimiter = gemini_limiter,
+    ) -> None:
+        """
+        Args:
+            llm (Any): chat model with an async `ainvoke(messages)`
+            max_retries (int, optional): retries after the first attempt
+            call_timeout (float, optional): deadline of each attempt, seconds
+            limiter (GeminiLimiter, optional): shared rate limiter and
+                circuit breaker
+        """
+        self.llm = llm
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.call_timeout = call_timeout
+        self.loop = get_event_loop()
+        self._in_flight: dict[str, asyncio.Future] = {}
+
+    def invoke(self, key: str, messages: list, estimated_tokens: int = 0) -> str:
+        """Call the model from synchronous code.
+
+        Args:
+            key (str): identity of the request, e.g. hash of the image
+            messages (list): chat messages
+            estimated_tokens (int, optional): tokens charged to the limiter
+
+        Returns:
+            str: response content
+        """
+        return self.submit(key, messages, estimated_tokens).result()
+
+    def submit(self, key: str, messages: list, estimated_tokens: int = 0) -> Future:
+        """Schedule a call on the client loop without waiting for it.
+
+        Args:
+            key (str): identity of the request, e.g. hash of the image
+            messages (list): chat messages
+            estimated_tokens (int, optional): tokens charged to the limiter
+
+        Returns:
+            Future: resolves to the response content
+        """
+        return asyncio.run_coroutine_threadsafe(
+            self.ainvoke(key, messages, estimated_tokens), self.loop
+        )
+
+    async def ainvoke(self, key: str, messages: list, estimated_tokens: int = 0) -> str:
+        """Call the model, sharing the in-flight call with the same key.
+
+        Args:
+            key (str): identity of the request, e.g. hash of the image
+            messages (list): chat messages
+            estimated_tokens (int, optional): tokens charged to the limiter
+
+        Returns:
+            str: response content
+        """
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(
+                self._call_with_retries(messages, estimated_tokens)
+            )
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # shield so that one cancelled caller does not cancel the others
+        return await asyncio.shield(future)
+
+    def stream(self, messages: list, estimated_tokens: int = 0) -> Iterator[str]:
+        """Call the model from synchronous code, yielding the response text
+        as it is generated.
+
+        Streamed calls are not coalesced. A failed attempt is retried only
+        if it failed before yielding any text.
+
+        Args:
+            messages (list): chat messages
+            estimated_tokens (int, optional): tokens charged to the limiter
+
+        Yields:
+            str: chunks of the response content
+        """
+        chunks: queue.Queue = queue.Queue()
+        done = object()
+
+        async def produce() -> None:
+            try:
+                async for chunk in self.astream(messages, estimated_tokens):
+                    chunks.put(chunk)
+            except BaseException as err:
+                chunks.put(err)
+            finally:
+                chunks.put(done)
+
+        future = asyncio.run_coroutine_threadsafe(produce(), self.loop)
+        try:
+            while (chunk := chunks.get()) is not done:
+                if isinstance(chunk, BaseException):
+                    raise chunk
+                yield chunk
+        finally:
+            # stop generating when the consumer goes away early
+            future.cancel()
+
+    async def astream(
+        self, messages: list, estimated_tokens: int = 0
+    ) -> AsyncIterator[str]:
+        """Call the model, yielding the response text as it is generated.
+
+        Args:
+            messages (list): chat messages
+            estimated_tokens (int, optional): tokens charged to the limiter
+
+        Yields:
+            str: chunks of the response content
+        """
+        for attempt in range(self.max_retries + 1):
+            trial = await self.limiter.acquire(estimated_tokens)
+            started = False
+            try:
+                async with _semaphore:
+                    stream = self.llm.astream(messages).__aiter__()
+                    while True:
+                        # each chunk has its own deadline
+                        try:
+                            chunk = await asyncio.wait_for(
+                                stream.__anext__(), self.call_timeout
+                            )
+                        except StopAsyncIteration:
+                            break
+                        if chunk.content:
+                            started = True
+                            yield chunk.content
+                self.limiter.breaker.record_success()
+                return
+            except Exception as err:
+                retryable = is_retryable(err)
+                if retryable:
+                    self.limiter.breaker.record_failure()
+                if started or attempt == self.max_retries or not retryable:
+                    raise AIError(f"Gemini request failed: {err!r}") from err
+            finally:
+                # non-retryable error, or the consumer went away
+                if trial:
+                    self.limiter.breaker.release_trial()
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt)
+            await asyncio.sleep(random.uniform(0, delay))
+
+    async def _call_with_retries(self, messages: list, estimated_tokens: int) -> str:
+        for attempt in range(self.max_retries + 1):
+            # raises CircuitOpenError right away while the breaker is open
+            trial = await self.limiter.acquire(estimated_tokens)
+            try:
+                async with _semaphore:
+                    response = await asyncio.wait_for(
+                        self.llm.ainvoke(messages), self.call_timeout
+                    )
+                self.limiter.breaker.record_success()
+                return response.content
+            except Exception as err:
+                retryable = is_retryable(err)
+                if retryable:
+                    self.limiter.breaker.record_failure()
+                if attempt == self.max_retries or not retryable:
+                    raise AIError(f"Gemini request failed: {err!r}") from err
+            finally:
+                # non-retryable error, or cancelled
+                if trial:
+                    self.limiter.breaker.release_trial()
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt)
+            await asyncio.sleep(random.uniform(0, delay))
+        raise AIError("Gemini request failed")
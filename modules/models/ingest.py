@@ -0,0 +1,61 @@
+import math
+import os
+from typing import IO
+
+from PIL import Image, ImageOps
+
+# Largest number of pixels kept from an uploaded photo
+MAX_PIXELS = int(os.getenv("INGEST_MAX_PIXELS", str(12_000_000)))
+# Longest image side Donut uses, its processor resizes to fit 960x1280 anyway
+DONUT_MAX_SIDE = 1280
+
+
+def load_image(file: str | IO[bytes], max_pixels: int = MAX_PIXELS) -> Image.Image:
+    """Decode an uploaded receipt photo once, for every backend.
+
+    Only the header is read to get the size, JPEGs are then decoded directly
+    at a reduced scale (draft mode) when the photo exceeds the pixel cap.
+    EXIF orientation is applied and the result is an RGB image of at most
+    `max_pixels` pixels.
+
+    Args:
+        file (str | IO[bytes]): path or file-like object of the photo
+        max_pixels (int, optional): pixel count cap
+
+    Returns:
+        Image.Image: decoded RGB image
+    """
+    image = Image.open(file)
+    width, height = image.size
+    if width * height > max_pixels:
+        scale = math.sqrt(max_pixels / (width * height))
+        # draft picks the smallest DCT scale (1/2, 1/4, 1/8) that is still
+        # at least the requested size, it is a no-op for non JPEG formats
+        image.draft("RGB", (math.ceil(width * scale), math.ceil(height * scale)))
+
+    image = ImageOps.exif_transpose(image)
+    if image.width * image.height > max_pixels:
+        scale = math.sqrt(max_pixels / (image.width * image.height))
+        image = image.resize(
+            (max(int(image.width * scale), 1), max(int(image.height * scale), 1)),
+            Image.Resampling.LANCZOS,
+        )
+    return image.convert("RGB")
+
+
+def fit_to_max_side(image: Image.Image, max_side: int | None) -> Image.Image:
+    """Downscale the image so that its longest side is at most `max_side`.
+
+    Args:
+        image (Image.Image): the image
+        max_side (int | None): longest side in pixels, None keeps the image
+
+    Returns:
+        Image.Image: the image itself if it already fits, a resized copy
+            otherwise
+    """
+    if max_side is None or max(image.size) <= max_side:
+        return image
+    scale = max_side / max(image.size)
+    size = (max(round(image.width * scale), 1), max(round(image.height * scale), 1))
+    return image.resize(size, Image.Resampling.LANCZOS)
@@ -1,14 +1,14 @@
 import re
-import torch
+import threading
+import numpy as np
 from PIL import Image
 import pytesseract
-from pytesseract import Output
-from transformers import LayoutLMv3Processor, LayoutLMv3Model
 import os
 import time
-from huggingface_hub import HfApi
 
-from .base import AIModel
+from . import tesseract_pool
+from .base import AIModel, ReadSignals
+from .ocr_preprocess import PreprocessConfig, preprocess
 
 import os
 
@@ -29,6 +29,13 @@ os.environ.setdefault("HTTPX_TIMEOUT", "300")
 
 MODEL_NAME = "microsoft/layoutlmv3-base"
 
+# Number of strips tall receipts are split into for parallel OCR, 1 disables
+OCR_STRIPS = int(os.getenv("OCR_STRIPS", "1"))
+# Only images at least this many times taller than wide are split
+OCR_TALL_RATIO = 2.0
+# Minimum height of a strip in pixels
+OCR_MIN_STRIP_HEIGHT = 400
+
 
 class LayoutLMv3ReceiptModel(AIModel):
     """
@@ -36,120 +43,221 @@ class LayoutLMv3ReceiptModel(AIModel):
     - OCR with pytesseract
     - Regex-based parsing (Indonesia-friendly)
     - LayoutLMv3 ready (forward skipped)
+
+    torch, the processor and the model weights are only loaded the first
+    time they are accessed, so the OCR + regex path starts instantly.
     """
 
-    def __init__(self):
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-        # Load with retry mechanism and increased timeout
-        max_retries = 3
-        retry_delay = 5 
-        
-        for attempt in range(max_retries):
-            try:
-                print(f"Loading LayoutLMv3 processor (attempt {attempt + 1}/{max_retries})...")
-                self.processor = LayoutLMv3Processor.from_pretrained(
-                    MODEL_NAME,
-                    apply_ocr=False,
-                    local_files_only=False
-                )
-                
-                print(f"Loading LayoutLMv3 model (attempt {attempt + 1}/{max_retries})...")
-                self.model = LayoutLMv3Model.from_pretrained(
-                    MODEL_NAME,
-                    local_files_only=False
-                ).to(self.device)
-                self.model.eval()
-                
-                print("LayoutLMv3 model loaded successfully!")
-                break  
-                
-            except Exception as e:
-                if attempt < max_retries - 1:
-                    print(f"Failed to load model (attempt {attempt + 1}): {e}")
-                    print(f"Retrying in {retry_delay} seconds...")
-                    time.sleep(retry_delay)
-                    retry_delay *= 2  # Exponential backoff
-                else:
-                    # Last attempt failed
-                    raise RuntimeError(
-                        f"Failed to load LayoutLMv3 model after {max_retries} attempts. "
-                        f"This may be due to network issues or Hugging Face being unavailable. "
-                        f"Please check your internet connection and try again. "
-                        f"Last error: {str(e)}"
-                    ) from e
+    def __init__(self, use_layoutlm=True, ocr_strips=OCR_STRIPS, preprocess_config=None):
+        """
+        Args:
+            use_layoutlm (bool, optional): run the LayoutLMv3 forward pass,
+                False gives the lightweight OCR-only profile that never
+                loads the transformer. Defaults to True.
+            ocr_strips (int, optional): split tall receipts into this many
+                overlapping strips OCR-ed in parallel. Defaults to the
+                OCR_STRIPS environment variable, or 1 (disabled).
+            preprocess_config (PreprocessConfig | None, optional): image
+                preconditioning before OCR. Defaults to all steps enabled.
+        """
+        self.use_layoutlm = use_layoutlm
+        self.ocr_strips = ocr_strips
+        self.preprocess_config = preprocess_config or PreprocessConfig()
+        self.last_preprocess_timings = {}
+        self._processor = None
+        self._model = None
+        self._load_lock = threading.Lock()
+
+    @property
+    def processor(self):
+        if self._processor is None:
+            self._load_transformer()
+        return self._processor
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._load_transformer()
+        return self._model
+
+    def _load_transformer(self):
+        with self._load_lock:
+            if self._model is not None:
+                return
+
+            import torch
+            from transformers import LayoutLMv3Processor, LayoutLMv3Model
+
+            self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+            # Load with retry mechanism and increased timeout
+            max_retries = 3
+            retry_delay = 5 
+            
+            for attempt in range(max_retries):
+                try:
+                    print(f"Loading LayoutLMv3 processor (attempt {attempt + 1}/{max_retries})...")
+                    processor = LayoutLMv3Processor.from_pretrained(
+                        MODEL_NAME,
+                        apply_ocr=False,
+                        local_files_only=False
+                    )
+                    
+                    print(f"Loading LayoutLMv3 model (attempt {attempt + 1}/{max_retries})...")
+                    model = LayoutLMv3Model.from_pretrained(
+                        MODEL_NAME,
+                        local_files_only=False
+                    ).to(self.device)
+                    model.eval()
+                    
+                    print("LayoutLMv3 model loaded successfully!")
+                    self._processor = processor
+                    self._model = model
+                    break  
+                    
+                except Exception as e:
+                    if attempt < max_retries - 1:
+                        print(f"Failed to load model (attempt {attempt + 1}): {e}")
+                        print(f"Retrying in {retry_delay} seconds...")
+                        time.sleep(retry_delay)
+                        retry_delay *= 2  # Exponential backoff
+                    else:
+                        # Last attempt failed
+                        raise RuntimeError(
+                            f"Failed to load LayoutLMv3 model after {max_retries} attempts. "
+                            f"This may be due to network issues or Hugging Face being unavailable. "
+                            f"Please check your internet connection and try again. "
+                            f"Last error: {str(e)}"
+                        ) from e
 
     # PUBLIC API
     def run(self, image):
+        return self.run_with_signals(image)[0]
+
+    def run_with_signals(self, image):
+        """
+        Read the receipt and report how trustworthy the reading is.
+
+        Returns:
+            tuple[ReceiptData, ReadSignals]: parsed receipt data, with the
+            mean OCR word confidence, the share of priced lines that
+            could not be parsed and whether a total line was read
+        """
         if isinstance(image, str):
             image = Image.open(image).convert("RGB")
 
-        words, boxes = self._ocr(image)
+        words, line_boxes, confidences, prepared = self._ocr(image)
 
         # LayoutLMv3 forward 
-        self._layoutlm_forward(image, words, boxes)
+        if self.use_layoutlm:
+            boxes = self._normalize_boxes(prepared.to_original(line_boxes), image)
+            self._layoutlm_forward(image, words, boxes)
 
-        return self._parse(words, boxes)
+        # rows are grouped on the deskewed boxes, where lines are straight
+        receipt, parse_failure_rate, total_read = self._parse_with_stats(words, line_boxes)
+        ocr_confidence = float(np.mean(confidences)) / 100 if len(confidences) else 0.0
+        return receipt, ReadSignals(ocr_confidence, parse_failure_rate, total_read)
 
     # OCR
     def _ocr(self, image):
-        data = pytesseract.image_to_data(image, output_type=Output.DICT)
+        """
+        OCR the preprocessed image.
 
-        words, boxes = [], []
+        Returns:
+            tuple[list[str], np.ndarray, np.ndarray, PreprocessResult]:
+            the words, their (N, 4) pixel boxes in the preprocessed
+            (deskewed) image, the word confidences and the preprocessing
+            result, mapping boxes back to the original image
+        """
+        prepared = preprocess(image, self.preprocess_config)
+        self.last_preprocess_timings = prepared.timings
+        ocr_image = prepared.image
+
+        # pooled in-process engines, subprocess fallback without libtesseract
+        strips = 1
+        if ocr_image.height >= OCR_TALL_RATIO * ocr_image.width:
+            strips = min(self.ocr_strips, ocr_image.height // OCR_MIN_STRIP_HEIGHT)
+        data = tesseract_pool.image_to_data_tiled(ocr_image, max(strips, 1))
+
+        texts = np.char.strip(np.asarray(data["text"], dtype=str))
+        keep = texts != ""
+        words = texts[keep].tolist()
+        confidences = np.asarray(data["conf"], dtype=float)[keep]
+        confidences = confidences[confidences >= 0]
+
+        left = np.asarray(data["left"])[keep]
+        top = np.asarray(data["top"])[keep]
+        right = left + np.asarray(data["width"])[keep]
+        bottom = top + np.asarray(data["height"])[keep]
+
+        boxes = np.stack([left, top, right, bottom], axis=1).reshape(-1, 4)
+        return words, boxes, confidences, prepared
+
+    def _normalize_boxes(self, boxes, image):
+        """
+        Normalize original image pixel boxes to 0-1000 as LayoutLMv3
+        expects, shape (N, 4).
+        """
         w, h = image.size
-
-        for i, text in enumerate(data["text"]):
-            text = text.strip()
-            if not text:
-                continue
-
-            words.append(text)
-
-            x1 = int(1000 * data["left"][i] / w)
-            y1 = int(1000 * data["top"][i] / h)
-            x2 = int(1000 * (data["left"][i] + data["width"][i]) / w)
-            y2 = int(1000 * (data["top"][i] + data["height"][i]) / h)
-
-            boxes.append([x1, y1, x2, y2])
-
-        return words, boxes
+        return (boxes * 1000 / np.array([w, h, w, h])).astype(int)
 
     # LayoutLMv3 FORWARD
     def _layoutlm_forward(self, image, words, boxes):
         """
         LayoutLMv3 forward pass
         (OCR + parsing already sufficient for receipt)
+
+        An implementation accesses self.processor / self.model, which
+        loads the transformer on first use.
         """
         pass
 
     # GROUP WORDS BY LINE
-    def _group_by_line(self, words, boxes, y_thresh=15):
-        lines = []
-        current = []
-        last_y = None
-
-        for w, b in zip(words, boxes):
-            y = b[1]
-            if last_y is None or abs(y - last_y) <= y_thresh:
-                current.append(w)
-            else:
-                lines.append(" ".join(current))
-                current = [w]
-            last_y = y
+    def _group_by_line(self, words, boxes):
+        """
+        Cluster words into rows by vertical overlap, independently of the
+        order Tesseract emitted them, then read each row left to right.
+
+        Words join the row whose span contains their vertical center (see
+        `_assign_rows`), so words from side-by-side columns share their row
+        while neighbouring lines never merge. Centers are first corrected
+        for the residual skew left by preprocessing.
+        """
+        if len(words) == 0:
+            return []
+
+        boxes = np.asarray(boxes, dtype=float)
+        center_x = (boxes[:, 0] + boxes[:, 2]) / 2
+        center_y = (boxes[:, 1] + boxes[:, 3]) / 2
+        heights = boxes[:, 3] - boxes[:, 1]
+
+        slope = _estimate_slope(center_x, center_y, heights)
+        row_ids = _assign_rows(center_y - slope * center_x, heights)
 
-        if current:
-            lines.append(" ".join(current))
+        order = np.lexsort((center_x, row_ids))
+        row_starts = np.flatnonzero(np.diff(row_ids[order])) + 1
 
-        return lines
+        words = np.asarray(words, dtype=object)
+        return [" ".join(row) for row in np.split(words[order], row_starts)]
 
     # MAIN PARSER
     def _parse(self, words, boxes):
+        return self._parse_with_stats(words, boxes)[0]
+
+    def _parse_with_stats(self, words, boxes):
+        """
+        Parse the words, also returning the share of lines holding a number
+        that yielded neither an item nor the total, and whether a total
+        line was read.
+        """
         from modules.data.receipt_data import ReceiptData
 
         lines = self._group_by_line(words, boxes)
 
         items = []
         total = 0.0
+        priced_lines = 0
+        failed_lines = 0
 
         for line in lines:
             low = line.lower()
@@ -163,15 +271,21 @@ class LayoutLMv3ReceiptModel(AIModel):
             item = self._parse_item(line)
             if item:
                 items.append(item)
+            if re.search(r"\d", line):
+                priced_lines += 1
+                failed_lines += item is None
 
         # fallback total
-        if total == 0.0:
+        total_read = total != 0.0
+        if not total_read:
             total = sum(i.total_price for i in items)
 
-        return ReceiptData(
+        receipt = ReceiptData(
             items={item.id: item for item in items},
             total=total
         )
+        failure_rate = failed_lines / priced_lines if priced_lines else 1.0
+        return receipt, failure_rate, total_read
 
     # ITEM PARSER
     def _parse_item(self, line):
@@ -236,3 +350,87 @@ class LayoutLMv3ReceiptModel(AIModel):
 
 
         return float(val)
+
+
+def _assign_rows(center_y, heights):
+    """
+    Row index of each word, rows numbered top to bottom.
+
+    Words are taken top to bottom. Each joins the row whose span, its mean
+    word height around its mean center, contains the word's center (the
+    closest row if several do) and starts a new row otherwise.
+
+    A row's mean center is at most its last word's center, so a row whose
+    last word is more than half the tallest word above the current one can
+    not contain it or any later word: only the few rows still in reach are
+    compared, which keeps the sweep linear.
+    """
+    reach = float(np.max(heights, initial=0.0)) / 2
+    center_y_list, heights_list = center_y.tolist(), heights.tolist()
+    # per row word counts, running sums of the centers and heights, and
+    # center of the last word
+    counts, center_sums, height_sums, last = [], [], [], []
+    active: list[int] = []
+    row_ids = np.empty(len(center_y), dtype=int)
+    for index in np.argsort(center_y, kind="stable").tolist():
+        y = center_y_list[index]
+        active = [row for row in active if last[row] >= y - reach]
+        row, best = -1, float("inf")
+        for candidate in active:
+            distance = abs(center_sums[candidate] / counts[candidate] - y)
+            if distance <= height_sums[candidate] / counts[candidate] / 2 and distance < best:
+                row, best = candidate, distance
+        if row < 0:
+            row = len(counts)
+            counts.append(0)
+            center_sums.append(0.0)
+            height_sums.append(0.0)
+            last.append(y)
+            active.append(row)
+        counts[row] += 1
+        center_sums[row] += y
+        height_sums[row] += heights_list[index]
+        last[row] = y
+        row_ids[index] = row
+    return row_ids
+
+
+def _estimate_slope(center_x, center_y, heights):
+    """
+    Residual skew of the page, as the median slope from each word to the
+    nearest word on its right that overlaps it vertically.
+
+    Words are sorted by center, so the candidates of a word are its
+    neighbours in that order within the largest vertical reach. They are
+    compared one offset at a time, in linear memory.
+    """
+    count = len(center_y)
+    order = np.argsort(center_y, kind="stable")
+    x, y, h = center_x[order], center_y[order], heights[order]
+    max_reach = (h + h.max()) / 4
+    positions = np.arange(count)
+    first = np.searchsorted(y, y - max_reach, side="left")
+    last = np.searchsorted(y, y + max_reach, side="right") - 1
+    span = int(max((positions - first).max(), (last - positions).max()))
+
+    best_dx = np.full(count, np.inf)
+    best_dy = np.zeros(count)
+    for offset in range(-span, span + 1):
+        if offset == 0:
+            continue
+        words = positions[max(-offset, 0):count - max(offset, 0)]
+        others = words + offset
+        dx = x[others] - x[words]
+        dy = y[others] - y[words]
+        closer = (
+            (dx > 0)
+            & (np.abs(dy) <= (h[words] + h[others]) / 4)
+            & (dx < best_dx[words])
+        )
+        best_dx[words[closer]] = dx[closer]
+        best_dy[words[closer]] = dy[closer]
+
+    found = np.isfinite(best_dx)
+    if not found.any():
+        return 0.0
+    return float(np.median(best_dy[found] / best_dx[found]))
@@ -1,36 +1,205 @@
+import functools
+import os
+import threading
 from enum import Enum
+from typing import Callable, TypeVar
+
 import streamlit as st
 
 from modules.utils import SettingsError
 from .base import AIModel
+from .cache import CachedModel, ExtractionCache
+from .ingest import DONUT_MAX_SIDE
+from .residency import ResidencyManager
+from .workers import INFERENCE_WORKERS, WORKER_MODELS, InferenceService, RemoteModel
+
+# Backends (ModelNames values) escalated to by the cascade, in order, and
+# raced against each other
+CASCADE_STAGES = os.getenv("CASCADE_STAGES", "Donut (int8 CPU),Gemini").split(",")
+RACE_STAGES = os.getenv("RACE_STAGES", "Donut (int8 CPU),Gemini").split(",")
+
+# Part of the extraction cache key, bump it whenever a backend's model or
+# parsing changes so that stale results are not served.
+MODEL_VERSION = "1"
+
+T = TypeVar("T")
+
+_singletons_lock = threading.RLock()
 
 
 class ModelNames(Enum):
     """Available model names."""
     GEMINI = "Gemini"
     DONUT = "Donut"
+    DONUT_INT8 = "Donut (int8 CPU)"
     LAYOUTLMV3 = "LayoutLMv3"
+    TESSERACT = "Tesseract (OCR only)"
+    CASCADE = "Cascade (OCR first)"
+    RACE = "Race (fastest valid)"
+
+
+# input_max_side of the backends run by the inference workers, whose models
+# are not loaded in this process, None for full resolution
+WORKER_INPUT_MAX_SIDES = {
+    ModelNames.DONUT: DONUT_MAX_SIDE,
+    ModelNames.DONUT_INT8: DONUT_MAX_SIDE,
+}
+
+
+def _process_wide(factory: Callable[[], T]) -> Callable[[], T]:
+    """Create the object once per process, on first use.
+
+    st.cache_resource stores nothing when called outside a session's script
+    thread, so the race threads and the warm-up would each get their own
+    copy. These singletons are shared by every thread instead.
+    """
+    instance: list[T] = []
+
+    @functools.wraps(factory)
+    def get() -> T:
+        with _singletons_lock:
+            if not instance:
+                instance.append(factory())
+            return instance[0]
+
+    return get
+
+
+def get_stage_names(model_name: ModelNames) -> list[ModelNames]:
+    """Backends a composite model runs, the model itself otherwise."""
+    if model_name == ModelNames.CASCADE:
+        return [ModelNames.TESSERACT] + [ModelNames(name.strip()) for name in CASCADE_STAGES]
+    if model_name == ModelNames.RACE:
+        return [ModelNames(name.strip()) for name in RACE_STAGES]
+    return [model_name]
+
+
+@_process_wide
+def get_extraction_cache() -> ExtractionCache:
+    """Get the extraction cache shared by all sessions and models."""
+    return ExtractionCache()
+
+
+@_process_wide
+def get_gemini_pool():
+    """Get the per API key pool of Gemini models."""
+    from .gemini import GeminiModelPool
+    return GeminiModelPool()
+
+
+def load_gemini_model(api_key: str | None) -> AIModel:
+    """Get the Gemini model of an API key, with the extraction cache."""
+    model = get_gemini_pool().get(api_key)
+    return CachedModel(
+        model, f"{ModelNames.GEMINI.value}:{MODEL_VERSION}", get_extraction_cache()
+    )
+
+
+def load_composite_model(model_name: ModelNames, api_key: str | None) -> AIModel:
+    """Get a cascade or race of backends, with the extraction cache.
+
+    Backends are only loaded when a receipt first reaches them.
+    """
+    from .cascade import CascadeModel, Stage
+
+    def loader(stage_name: ModelNames):
+        if stage_name == ModelNames.GEMINI:
+            return lambda: get_gemini_pool().get(api_key)
+        # the bare model, the composite result is cached as a whole
+        return lambda: load_backend(stage_name)
+
+    stage_names = get_stage_names(model_name)
+    stages = [Stage(name.value, loader(name)) for name in stage_names]
+    mode = "race" if model_name == ModelNames.RACE else "cascade"
+    stages_key = ",".join(name.value for name in stage_names)
+    return CachedModel(
+        CascadeModel(stages, mode=mode),
+        f"{model_name.value}[{stages_key}]:{MODEL_VERSION}",
+        get_extraction_cache(),
+    )
+
+
+@_process_wide
+def get_residency_manager() -> ResidencyManager:
+    """Get the manager keeping local models within the memory budget."""
+    return ResidencyManager(_create_local_model)
+
+
+@_process_wide
+def get_inference_service() -> InferenceService | None:
+    """Get the worker process pool, None when inference runs in-process."""
+    if INFERENCE_WORKERS <= 0:
+        return None
+    service = InferenceService()
+    service.start()
+    return service
+
+
+def load_backend(model_name: ModelNames) -> AIModel:
+    """Get the bare model of a backend, loading it if needed.
+
+    Shows nothing, so it can run outside the script thread of a session.
+    Backends run by the inference workers are only referenced here, the
+    workers load them.
+    """
+    service = get_inference_service()
+    if service is not None and model_name.value in WORKER_MODELS:
+        return RemoteModel(service, model_name.value, WORKER_INPUT_MAX_SIDES.get(model_name))
+    return get_residency_manager().load(model_name)
 
 
-@st.cache_resource(show_spinner="Loading AI Model...")
 def load_model_cached(model_name: ModelNames) -> AIModel:
-    """Load AI model with caching."""
-    
+    """Load AI model, kept resident while the memory budget allows."""
+    service = get_inference_service()
+    remote = service is not None and model_name.value in WORKER_MODELS
+    if remote or get_residency_manager().is_resident(model_name):
+        model = load_backend(model_name)
+    else:
+        with st.spinner("Loading AI Model..."):
+            model = load_backend(model_name)
+    return CachedModel(
+        model, f"{model_name.value}:{MODEL_VERSION}", get_extraction_cache()
+    )
+
+
+def _create_model(model_name: ModelNames) -> AIModel:
+    """Create a new instance of the AI model."""
     if model_name == ModelNames.GEMINI:
-        from .gemini import GeminiModel
-        return GeminiModel()
+        # server-wide key, sessions use load_gemini_model with their own
+        return get_gemini_pool().get(os.environ.get("GOOGLE_API_KEY"))
 
     elif model_name == ModelNames.DONUT:
         from .donut import DonutModel
         return DonutModel()
 
+    elif model_name == ModelNames.DONUT_INT8:
+        from .donut import DonutModel
+        return DonutModel(quantized=True)
+
     elif model_name == ModelNames.LAYOUTLMV3:
         from .layoutlmv3 import LayoutLMv3ReceiptModel
         return LayoutLMv3ReceiptModel()
 
+    elif model_name == ModelNames.TESSERACT:
+        from .layoutlmv3 import LayoutLMv3ReceiptModel
+        return LayoutLMv3ReceiptModel(use_layoutlm=False)
+
     raise SettingsError(f"Model loader not implemented for {model_name}")
 
 
+def _create_local_model(model_name: ModelNames) -> AIModel:
+    """Create a model run in this process by all sessions.
+
+    Donut is wrapped to batch the concurrent requests of the sessions. The
+    inference workers run one job at a time, so they use `_create_model`.
+    """
+    model = _create_model(model_name)
+    if model_name in (ModelNames.DONUT, ModelNames.DONUT_INT8):
+        from .batching import MicroBatcher
+        return MicroBatcher(model)
+    return model
+
+
 def _load_model() -> AIModel:
     """Load model based on session settings."""
     from modules.data import session_data
@@ -49,6 +218,40 @@ def _load_model() -> AIModel:
             # Default to Gemini if not found, or raise
             raise SettingsError(f"Model name is not recognized: {model_name_str}")
 
+    if model_name == ModelNames.GEMINI:
+        return load_gemini_model(session_data.gemini_api_key.get())
+    if model_name in (ModelNames.CASCADE, ModelNames.RACE):
+        # kept per session, reset when the model or API key setting changes
+        model = session_data.model.get()
+        if model is None:
+            model = load_composite_model(model_name, session_data.gemini_api_key.get())
+            session_data.model.set(model)
+        return model
+    return _load_serving_model(model_name)
+
+
+def _load_serving_model(model_name: ModelNames) -> AIModel:
+    """Load a local model, keeping the previous one while it loads.
+
+    When the session switched models and the new one is not loaded yet,
+    it loads in the background and the previous model, if still resident,
+    keeps reading receipts until then.
+    """
+    from modules.data import session_data
+
+    manager = get_residency_manager()
+    serving = session_data.serving_model_name.get()
+    if serving is not None and serving != model_name and manager.is_resident(serving):
+        was_loading = manager.is_loading(model_name)
+        if not manager.prefetch(model_name).done():
+            if not was_loading:
+                st.toast(
+                    f"{model_name.value} is loading, {serving.value} reads "
+                    "receipts until it is ready."
+                )
+            return load_model_cached(serving)
+
+    session_data.serving_model_name.set(model_name)
     return load_model_cached(model_name)
 
 
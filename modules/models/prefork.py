@@ -0,0 +1,71 @@
+"""
+Models preloaded once by the fork server the inference workers are forked
+from, so that every worker shares their weight pages copy-on-write.
+
+Importing this module loads the models, it is meant to be imported by the
+fork server only.
+"""
+
+import logging
+import os
+import sys
+import time
+
+from .workers import WORKER_MODELS
+
+logger = logging.getLogger(__name__)
+
+# Backends (ModelNames values) preloaded for the workers
+PREFORK_MODELS = [
+    name.strip()
+    for name in os.getenv("PREFORK_MODELS", ",".join(WORKER_MODELS)).split(",")
+    if name.strip()
+]
+
+models: dict = {}
+torch_threads: int | None = None
+
+
+def _preload() -> None:
+    global torch_threads
+    from .loader import ModelNames, _create_model
+
+    try:
+        import torch
+    except ImportError:
+        pass
+    else:
+        # no OpenMP thread team may exist in a process that forks, workers
+        # get their threads back with `restore_threads`
+        torch_threads = torch.get_num_threads()
+        torch.set_num_threads(1)
+
+    for name in PREFORK_MODELS:
+        start = time.perf_counter()
+        try:
+            models[name] = _create_model(ModelNames(name))
+        except Exception:
+            logger.exception("Preloading %s failed, workers will load it", name)
+            continue
+        logger.info("Preloaded %s in %.1fs", name, time.perf_counter() - start)
+
+
+def take(name: str):
+    """Get a preloaded model, once per worker.
+
+    Args:
+        name (str): ModelNames value of the backend
+
+    Returns:
+        AIModel | None: the model, None if it was not preloaded
+    """
+    return models.pop(name, None)
+
+
+def restore_threads() -> None:
+    """Give a forked worker torch's default number of threads back."""
+    if torch_threads is not None:
+        sys.modules["torch"].set_num_threads(torch_threads)
+
+
+_preload()
@@ -0,0 +1,188 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+
+from modules.utils import AIError
+
+REQUESTS_PER_MINUTE = int(os.getenv("GEMINI_RPM", "15"))
+TOKENS_PER_MINUTE = int(os.getenv("GEMINI_TPM", "250000"))
+BREAKER_FAILURES = int(os.getenv("GEMINI_BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("GEMINI_BREAKER_COOLDOWN", "30"))
+
+
+class CircuitOpenError(AIError):
+    """Raised when calls are refused because the circuit breaker is open."""
+
+    pass
+
+
+class TokenBucket:
+    """Token bucket refilled continuously up to a per-minute capacity."""
+
+    def __init__(self, per_minute: int) -> None:
+        self.capacity = float(max(per_minute, 1))
+        self.rate = self.capacity / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def available(self) -> float:
+        """Number of tokens that can be taken right now."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` tokens are available, 0 if they are now."""
+        missing = min(amount, self.capacity) - self.available()
+        return max(missing / self.rate, 0.0)
+
+    def take(self, amount: float) -> None:
+        self.tokens -= min(amount, self.capacity)
+
+
+class CircuitBreaker:
+    """Stops calling a failing service for a while.
+
+    The breaker opens after a number of consecutive failures and refuses
+    calls until the cooldown is over. It then lets one trial call through
+    (half-open), which closes it on success and reopens it on failure. A
+    trial ending without a verdict (a non-retryable error, a cancellation)
+    is released, letting the next call through as the trial.
+    """
+
+    def __init__(
+        self, failure_threshold: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN
+    ) -> None:
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        """Breaker state: closed, open or half-open."""
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half-open"
+
+    def check(self) -> bool:
+        """Raise if a call is not allowed right now.
+
+        Returns:
+            bool: whether the call is the half-open trial, which must end
+                with `record_success`, `record_failure` or `release_trial`
+
+        Raises:
+            CircuitOpenError: when open, or half-open with a trial in flight
+        """
+        state = self.state
+        if state == "open" or (state == "half-open" and self.trial_in_flight):
+            raise CircuitOpenError(
+                "Gemini is temporarily unavailable (too many failed requests), "
+                "please try again later."
+            )
+        if state == "half-open":
+            self.trial_in_flight = True
+            return True
+        return False
+
+    def release_trial(self) -> None:
+        """End the trial call without counting it as a success or failure."""
+        self.trial_in_flight = False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+@dataclass
+class LimiterState:
+    """Snapshot of the Gemini limiter, for display."""
+
+    requests_available: float
+    requests_per_minute: float
+    tokens_available: float
+    tokens_per_minute: float
+    waiting: int
+    breaker: str
+
+
+class GeminiLimiter:
+    """Process-wide request and token rate limiter with a circuit breaker.
+
+    Callers wait in arrival order: the queue lock of asyncio is FIFO and only
+    its holder waits for the buckets to refill.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: int = REQUESTS_PER_MINUTE,
+        tokens_per_minute: int = TOKENS_PER_MINUTE,
+    ) -> None:
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.breaker = CircuitBreaker()
+        self.waiting = 0
+        self._queue = asyncio.Lock()
+
+    async def acquire(self, estimated_tokens: int) -> bool:
+        """Wait for the turn and the quota of a call.
+
+        Args:
+            estimated_tokens (int): estimated tokens used by the call
+
+        Returns:
+            bool: whether the call is the breaker's half-open trial, see
+                `CircuitBreaker.check`
+
+        Raises:
+            CircuitOpenError: if the breaker is open
+        """
+        trial = self.breaker.check()
+        self.waiting += 1
+        try:
+            async with self._queue:
+                while True:
+                    delay = max(
+                        self.requests.wait_time(1),
+                        self.tokens.wait_time(estimated_tokens),
+                    )
+                    if delay <= 0:
+                        break
+                    await asyncio.sleep(delay)
+                self.requests.take(1)
+                self.tokens.take(estimated_tokens)
+        except BaseException:
+            # cancelled while waiting
+            if trial:
+                self.breaker.release_trial()
+            raise
+        finally:
+            self.waiting -= 1
+        return trial
+
+    def state(self) -> LimiterState:
+        """Current limiter state."""
+        return LimiterState(
+            requests_available=self.requests.available(),
+            requests_per_minute=self.requests.capacity,
+            tokens_available=self.tokens.available(),
+            tokens_per_minute=self.tokens.capacity,
+            waiting=self.waiting,
+            breaker=self.breaker.state,
+        )
+
+
+gemini_limiter = GeminiLimiter()
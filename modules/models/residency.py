@@ -0,0 +1,240 @@
+import gc
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Hashable
+
+from .base import AIModel
+
+logger = logging.getLogger(__name__)
+
+# Resident memory of the process above which least recently used models are
+# evicted, in MB, 0 for no limit
+MEMORY_BUDGET_MB = int(os.getenv("MODEL_MEMORY_BUDGET_MB", "0"))
+# Number of load and evict events kept for display
+EVENT_HISTORY = 50
+
+
+def current_rss() -> int:
+    """Resident set size of this process in bytes.
+
+    Read from /proc on Linux, the peak size is used on other platforms.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def process_memory(pid: int) -> tuple[int, int]:
+    """Proportional and unique set size of a process in bytes, Linux only.
+
+    Pages shared by several processes count fully in the RSS of each of
+    them, in the PSS they are split between them. The unique set size only
+    counts private pages.
+
+    Args:
+        pid (int): process id
+
+    Returns:
+        tuple[int, int]: PSS and USS
+    """
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as smaps:
+        for line in smaps:
+            key, _, rest = line.partition(":")
+            if rest.strip().endswith("kB"):
+                values[key] = int(rest.split()[0]) * 1024
+    return values["Pss"], values["Private_Clean"] + values["Private_Dirty"]
+
+
+def weights_size(model: AIModel) -> int:
+    """Bytes of the torch weights a model currently holds.
+
+    Only attributes already set are inspected, lazily loaded weights are
+    not loaded by this. Wrapped models are inspected too.
+    """
+    torch = sys.modules.get("torch")
+    if torch is None:
+        return 0
+    total = 0
+    for value in vars(model).values():
+        if isinstance(value, torch.nn.Module):
+            for tensor in (*value.parameters(), *value.buffers()):
+                total += tensor.numel() * tensor.element_size()
+        elif isinstance(value, AIModel):
+            total += weights_size(value)
+    return total
+
+
+@dataclass
+class ResidencyEvent:
+    """A model load or eviction."""
+
+    time: float
+    # load, evict or fail
+    kind: str
+    model: str
+    size: int
+    rss: int
+    seconds: float = 0.0
+
+
+@dataclass
+class Resident:
+    model: AIModel
+    # growth of the process RSS while loading
+    load_size: int
+    last_used: float
+
+    @property
+    def size(self) -> int:
+        return max(self.load_size, weights_size(self.model))
+
+
+class ResidencyManager:
+    """Keeps loaded models within a memory budget.
+
+    Models are loaded on demand, blocking with `load` or in the background
+    with `prefetch`, and the least recently used ones are evicted while the
+    process RSS exceeds the budget. The most recently used model is kept
+    through a background load, so it can keep serving while the next one
+    loads. An evicted model stays usable by calls already holding it.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[Hashable], AIModel],
+        budget_mb: int = MEMORY_BUDGET_MB,
+    ) -> None:
+        """
+        Args:
+            factory (Callable[[Hashable], AIModel]): creates the model of a key
+            budget_mb (int, optional): RSS budget in MB, 0 for no limit
+        """
+        self.factory = factory
+        self.budget = budget_mb * 1024 * 1024
+        self.events: deque[ResidencyEvent] = deque(maxlen=EVENT_HISTORY)
+        self._residents: OrderedDict[Hashable, Resident] = OrderedDict()
+        self._loading: dict[Hashable, Future] = {}
+        self._lock = threading.RLock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-load")
+
+    def is_resident(self, key: Hashable) -> bool:
+        return key in self._residents
+
+    def is_loading(self, key: Hashable) -> bool:
+        return key in self._loading
+
+    def load(self, key: Hashable) -> AIModel:
+        """Get a model, loading it if needed and waiting for it.
+
+        Args:
+            key (Hashable): model key
+
+        Returns:
+            AIModel: the loaded model
+        """
+        with self._lock:
+            resident = self._residents.get(key)
+            if resident is not None:
+                resident.last_used = time.monotonic()
+                self._residents.move_to_end(key)
+                return resident.model
+            future = self._loading.get(key)
+            if future is None:
+                future = Future()
+                self._loading[key] = future
+                owner = True
+            else:
+                owner = False
+        if owner:
+            self._load_into(key, future)
+        return future.result()
+
+    def prefetch(self, key: Hashable) -> Future:
+        """Start loading a model in the background.
+
+        Args:
+            key (Hashable): model key
+
+        Returns:
+            Future: resolves to the loaded model
+        """
+        with self._lock:
+            if key in self._residents:
+                future = Future()
+                future.set_result(self._residents[key].model)
+                return future
+            future = self._loading.get(key)
+            if future is None:
+                future = Future()
+                self._loading[key] = future
+                self._executor.submit(self._load_into, key, future)
+            return future
+
+    def residents(self) -> list[tuple[Hashable, int]]:
+        """Resident models and their sizes in bytes, least recent first."""
+        with self._lock:
+            return [(key, resident.size) for key, resident in self._residents.items()]
+
+    def _load_into(self, key: Hashable, future: Future) -> None:
+        start = time.perf_counter()
+        # make room beforehand, but keep the model currently serving
+        self._evict_over_budget(keep=1)
+        rss_before = current_rss()
+        try:
+            model = self.factory(key)
+        except BaseException as err:
+            with self._lock:
+                self._loading.pop(key, None)
+            self._record("fail", key, 0, time.perf_counter() - start)
+            future.set_exception(err)
+            return
+
+        rss = current_rss()
+        resident = Resident(model, max(rss - rss_before, 0), time.monotonic())
+        with self._lock:
+            self._residents[key] = resident
+            self._loading.pop(key, None)
+        self._record("load", key, resident.size, time.perf_counter() - start)
+        future.set_result(model)
+        self._evict_over_budget(keep=1)
+
+    def _evict_over_budget(self, keep: int) -> None:
+        if not self.budget:
+            return
+        while current_rss() > self.budget:
+            with self._lock:
+                if len(self._residents) <= keep:
+                    return
+                key, resident = self._residents.popitem(last=False)
+            size = resident.size
+            del resident
+            gc.collect()
+            torch = sys.modules.get("torch")
+            if torch is not None and torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            self._record("evict", key, size)
+
+    def _record(self, kind: str, key: Hashable, size: int, seconds: float = 0.0) -> None:
+        name = str(getattr(key, "value", key))
+        event = ResidencyEvent(time.time(), kind, name, size, current_rss(), seconds)
+        self.events.append(event)
+        logger.info(
+            "Model %s %s: %.0f MB in %.1fs, process RSS %.0f MB",
+            event.kind,
+            event.model,
+            size / 2**20,
+            seconds,
+            event.rss / 2**20,
+        )
@@ -0,0 +1,293 @@
+import ctypes
+import ctypes.util
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Iterator
+
+import pytesseract
+from PIL import Image
+from pytesseract import Output
+
+TESSERACT_LIB = os.getenv("TESSERACT_LIB") or ctypes.util.find_library("tesseract")
+TESSERACT_LANG = os.getenv("TESSERACT_LANG", "eng")
+POOL_SIZE = int(os.getenv("TESSERACT_POOL_SIZE", str(min(4, os.cpu_count() or 1))))
+# Same fallback resolution as the tesseract CLI when the image has none
+DEFAULT_DPI = 70
+# Overlap between OCR strips in pixels, must exceed a text line height
+STRIP_OVERLAP = 64
+
+TSV_COLUMNS = [
+    "level", "page_num", "block_num", "par_num", "line_num", "word_num",
+    "left", "top", "width", "height", "conf", "text",
+]
+
+
+def _load_library() -> ctypes.CDLL | None:
+    if not TESSERACT_LIB:
+        return None
+    try:
+        lib = ctypes.CDLL(TESSERACT_LIB)
+    except OSError:
+        return None
+
+    lib.TessBaseAPICreate.restype = ctypes.c_void_p
+    lib.TessBaseAPIDelete.argtypes = [ctypes.c_void_p]
+    lib.TessBaseAPIEnd.argtypes = [ctypes.c_void_p]
+    lib.TessBaseAPIInit3.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]
+    lib.TessBaseAPIInit3.restype = ctypes.c_int
+    lib.TessBaseAPISetImage.argtypes = [
+        ctypes.c_void_p, ctypes.c_void_p,
+        ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+    ]
+    lib.TessBaseAPISetSourceResolution.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    lib.TessBaseAPIRecognize.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+    lib.TessBaseAPIRecognize.restype = ctypes.c_int
+    lib.TessBaseAPIGetTsvText.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    lib.TessBaseAPIGetTsvText.restype = ctypes.c_void_p
+    lib.TessBaseAPIGetInitLanguagesAsString.argtypes = [ctypes.c_void_p]
+    lib.TessBaseAPIGetInitLanguagesAsString.restype = ctypes.c_char_p
+    lib.TessBaseAPIClear.argtypes = [ctypes.c_void_p]
+    lib.TessDeleteText.argtypes = [ctypes.c_void_p]
+    return lib
+
+
+class TesseractEngine:
+    """A Tesseract engine initialized once and reused across calls."""
+
+    def __init__(self, lib: ctypes.CDLL, lang: str = TESSERACT_LANG) -> None:
+        """Create and initialize the engine, loading the language data.
+
+        Args:
+            lib (ctypes.CDLL): the loaded libtesseract
+            lang (str, optional): tesseract language codes, e.g. "eng+ind"
+
+        Raises:
+            RuntimeError: if the engine can not be initialized
+        """
+        self.lib = lib
+        self.lang = lang
+        self.handle = lib.TessBaseAPICreate()
+        if lib.TessBaseAPIInit3(self.handle, None, lang.encode()) != 0:
+            self.close()
+            raise RuntimeError(f"Unable to initialize tesseract for '{lang}'")
+
+    def is_healthy(self) -> bool:
+        """Check that the engine is still initialized with its languages."""
+        if self.handle is None:
+            return False
+        languages = self.lib.TessBaseAPIGetInitLanguagesAsString(self.handle)
+        return bool(languages)
+
+    def image_to_data(self, image: Image.Image) -> dict[str, list]:
+        """Recognize the image, returning the same dict as pytesseract.
+
+        Args:
+            image (Image.Image): the image to recognize
+
+        Returns:
+            dict[str, list]: `pytesseract.image_to_data` style output
+        """
+        rgb = image.convert("RGB")
+        pixels = rgb.tobytes()
+        self.lib.TessBaseAPISetImage(
+            self.handle, pixels, rgb.width, rgb.height, 3, rgb.width * 3
+        )
+        dpi = image.info.get("dpi", (DEFAULT_DPI,))[0]
+        self.lib.TessBaseAPISetSourceResolution(self.handle, int(dpi) or DEFAULT_DPI)
+        try:
+            if self.lib.TessBaseAPIRecognize(self.handle, None) != 0:
+                raise RuntimeError("Tesseract recognition failed")
+            text_ptr = self.lib.TessBaseAPIGetTsvText(self.handle, 0)
+            if not text_ptr:
+                raise RuntimeError("Tesseract returned no TSV output")
+            try:
+                tsv = ctypes.string_at(text_ptr).decode("utf-8", errors="replace")
+            finally:
+                self.lib.TessDeleteText(text_ptr)
+        finally:
+            self.lib.TessBaseAPIClear(self.handle)
+        return _parse_tsv(tsv)
+
+    def close(self) -> None:
+        """Release the engine."""
+        if self.handle is not None:
+            self.lib.TessBaseAPIEnd(self.handle)
+            self.lib.TessBaseAPIDelete(self.handle)
+            self.handle = None
+
+
+class TesseractPool:
+    """Bounded pool of long-lived Tesseract engines.
+
+    Engines are created on demand up to the pool size, a caller waits when
+    all of them are busy. An engine that fails or does not pass its health
+    check is closed and replaced by a fresh one.
+    """
+
+    def __init__(self, lib: ctypes.CDLL, size: int = POOL_SIZE) -> None:
+        """
+        Args:
+            lib (ctypes.CDLL): the loaded libtesseract
+            size (int, optional): maximum number of engines
+        """
+        self.lib = lib
+        self.size = max(size, 1)
+        self._idle: queue.LifoQueue[TesseractEngine] = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def acquire(self) -> Iterator[TesseractEngine]:
+        """Borrow an engine for the duration of the context."""
+        engine = self._get()
+        try:
+            yield engine
+        except Exception:
+            self._discard(engine)
+            raise
+        self._idle.put(engine)
+
+    def image_to_data(self, image: Image.Image) -> dict[str, list]:
+        """Recognize the image with a pooled engine.
+
+        Args:
+            image (Image.Image): the image to recognize
+
+        Returns:
+            dict[str, list]: `pytesseract.image_to_data` style output
+        """
+        with self.acquire() as engine:
+            return engine.image_to_data(image)
+
+    def _get(self) -> TesseractEngine:
+        while True:
+            try:
+                engine = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    can_create = self._created < self.size
+                    if can_create:
+                        self._created += 1
+                if can_create:
+                    try:
+                        return TesseractEngine(self.lib)
+                    except Exception:
+                        with self._lock:
+                            self._created -= 1
+                        raise
+                engine = self._idle.get()
+
+            if engine.is_healthy():
+                return engine
+            self._discard(engine)
+
+    def _discard(self, engine: TesseractEngine) -> None:
+        engine.close()
+        with self._lock:
+            self._created -= 1
+
+
+_pool: TesseractPool | None = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> TesseractPool | None:
+    """Get the process-wide engine pool.
+
+    Returns:
+        TesseractPool | None: the pool, None if libtesseract is not available
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            lib = _load_library()
+            if lib is not None:
+                _pool = TesseractPool(lib)
+        return _pool
+
+
+def image_to_data(image: Image.Image) -> dict[str, list]:
+    """Run OCR on the image, with a pooled engine when available.
+
+    Falls back to the pytesseract subprocess when libtesseract can not be
+    loaded.
+
+    Args:
+        image (Image.Image): the image to recognize
+
+    Returns:
+        dict[str, list]: `pytesseract.image_to_data` style output
+    """
+    pool = get_pool()
+    if pool is None:
+        return pytesseract.image_to_data(
+            image, lang=TESSERACT_LANG, output_type=Output.DICT
+        )
+    return pool.image_to_data(image)
+
+
+def image_to_data_tiled(
+    image: Image.Image, strips: int, overlap: int = STRIP_OVERLAP
+) -> dict[str, list]:
+    """Run OCR on overlapping horizontal strips of the image in parallel.
+
+    Each strip owns the words whose vertical center falls in its part of
+    the page, so words read twice in an overlap are kept only once. Boxes
+    are returned in page coordinates.
+
+    Args:
+        image (Image.Image): the image to recognize
+        strips (int): number of strips, 1 disables tiling
+        overlap (int, optional): pixels shared by neighbouring strips
+
+    Returns:
+        dict[str, list]: `pytesseract.image_to_data` style output
+    """
+    if strips <= 1:
+        return image_to_data(image)
+
+    bounds = [round(i * image.height / strips) for i in range(strips + 1)]
+    crops = []
+    for index in range(strips):
+        top = max(bounds[index] - overlap, 0)
+        bottom = min(bounds[index + 1] + overlap, image.height)
+        strip = image.crop((0, top, image.width, bottom))
+        if "dpi" in image.info:
+            strip.info["dpi"] = image.info["dpi"]
+        crops.append((top, strip))
+
+    # recognition runs outside the GIL (C API) or in tesseract subprocesses,
+    # so threads are enough to use several cores
+    with ThreadPoolExecutor(max_workers=strips) as executor:
+        results = list(executor.map(lambda crop: image_to_data(crop[1]), crops))
+
+    merged: dict[str, list] = {column: [] for column in TSV_COLUMNS}
+    for index, ((top, _), data) in enumerate(zip(crops, results)):
+        for i in range(len(data["text"])):
+            page_top = data["top"][i] + top
+            center = page_top + data["height"][i] / 2
+            if not bounds[index] <= center < bounds[index + 1]:
+                continue
+            for column in TSV_COLUMNS:
+                merged[column].append(data[column][i])
+            merged["top"][-1] = page_top
+            # keep block numbers unique across strips
+            merged["block_num"][-1] += index * 10000
+    return merged
+
+
+def _parse_tsv(tsv: str) -> dict[str, list]:
+    data: dict[str, list] = {column: [] for column in TSV_COLUMNS}
+    for row in tsv.splitlines():
+        values = row.split("\t", len(TSV_COLUMNS) - 1)
+        if len(values) < len(TSV_COLUMNS) - 1 or not values[0].isdigit():
+            continue
+        values += [""] * (len(TSV_COLUMNS) - len(values))
+        for column, value in zip(TSV_COLUMNS[:-2], values):
+            data[column].append(int(value))
+        data["conf"].append(float(values[-2]))
+        data["text"].append(values[-1])
+    return data
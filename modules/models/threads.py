@@ -0,0 +1,80 @@
+import os
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+import torch
+
+
+def _available_cores() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+# Cores shared by the torch inferences of this process
+CPU_THREADS = int(os.getenv("INFERENCE_CPU_THREADS", str(_available_cores())))
+
+
+class ThreadBudget:
+    """Splits the cores between the torch inferences running at once.
+
+    Each inference holds a slot and runs with an equal share of the cores
+    between the inferences running or waiting when it starts, at least one
+    and at most the cores no other inference holds. An inference waits
+    while every core is held, so the threads of the running inferences
+    never add up to more than the cores.
+
+    torch thread counts are partly process-wide: the OpenMP count is per
+    thread, but the MKL count and the count inherited by new threads are
+    shared by the process. Concurrent changes would overwrite each other,
+    so the share is only set when an inference takes its slot, under the
+    budget lock. A running inference keeps its share: it does not shrink
+    when others start, nor grow back when they end.
+    """
+
+    def __init__(self, total: int = CPU_THREADS) -> None:
+        """
+        Args:
+            total (int, optional): number of cores to share
+        """
+        self.total = max(total, 1)
+        self.in_flight = 0
+        self.waiting = 0
+        # threads held by the running inferences
+        self.allocated = 0
+        self._changed = threading.Condition()
+
+    def resize(self, total: int) -> None:
+        """Change the number of cores shared, while no inference runs."""
+        self.total = max(total, 1)
+
+    def share(self) -> int:
+        """Number of threads the next inference to start gets right now."""
+        contenders = self.in_flight + max(self.waiting, 1)
+        fair = max(self.total // contenders, 1)
+        return max(min(fair, self.total - self.allocated), 0)
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """Run the enclosed inference within the budget."""
+        with self._changed:
+            self.waiting += 1
+            while self.allocated >= self.total:
+                self._changed.wait()
+            threads = self.share()
+            self.waiting -= 1
+            self.in_flight += 1
+            self.allocated += threads
+            if torch.get_num_threads() != threads:
+                torch.set_num_threads(threads)
+        try:
+            yield
+        finally:
+            with self._changed:
+                self.in_flight -= 1
+                self.allocated -= threads
+                self._changed.notify_all()
+
+
+cpu_threads = ThreadBudget()
@@ -0,0 +1,119 @@
+import logging
+import os
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from .ingest import load_image
+from .loader import ModelNames, get_gemini_pool, load_backend
+
+logger = logging.getLogger(__name__)
+
+# Backends (ModelNames values) loaded when the server starts
+WARMUP_MODELS = [
+    name.strip()
+    for name in os.getenv("WARMUP_MODELS", "Tesseract (OCR only)").split(",")
+    if name.strip()
+]
+# Receipt the warm-up inference runs on
+WARMUP_SAMPLE = Path(
+    os.getenv("WARMUP_SAMPLE", Path(__file__).parents[2] / "receipt1.jpg")
+)
+# Written once warm-up is done, for the container health check to probe
+READY_FILE = Path(
+    os.getenv("WARMUP_READY_FILE", Path(tempfile.gettempdir()) / "smart-split-bill.ready")
+)
+
+
+@dataclass
+class WarmupStatus:
+    """Warm-up progress of one backend."""
+
+    # pending, loading, warming, ready or failed
+    state: str = "pending"
+    seconds: float = 0.0
+    error: str | None = None
+
+    @property
+    def done(self) -> bool:
+        return self.state in ("ready", "failed")
+
+
+class Warmup:
+    """Loads backends on a background thread and runs one inference each.
+
+    The ready file is removed when warm-up starts and written once every
+    backend finished warming up, failed ones included. Models are loaded
+    into the process-wide residency manager or worker pool, the same ones
+    the sessions use.
+    """
+
+    def __init__(
+        self, model_names: list[str] = WARMUP_MODELS, ready_file: Path = READY_FILE
+    ) -> None:
+        self.statuses = {ModelNames(name): WarmupStatus() for name in model_names}
+        self.ready_file = ready_file
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """Start warming up, once per process."""
+        with self._lock:
+            if self._thread is None:
+                # left over by a previous run of the container
+                self.ready_file.unlink(missing_ok=True)
+                self._thread = threading.Thread(
+                    target=self._run, name="model-warmup", daemon=True
+                )
+                self._thread.start()
+
+    def is_ready(self) -> bool:
+        """Whether every backend finished warming up, failed ones included."""
+        return all(status.done for status in self.statuses.values())
+
+    def warming(self, model_names: list[ModelNames]) -> list[ModelNames]:
+        """Backends of `model_names` that are still warming up."""
+        if self._thread is None:
+            # server started without warm-up, models load on first use
+            return []
+        return [
+            name
+            for name in model_names
+            if name in self.statuses and not self.statuses[name].done
+        ]
+
+    def _run(self) -> None:
+        sample = None
+        for model_name, status in self.statuses.items():
+            start = time.perf_counter()
+            try:
+                status.state = "loading"
+                if model_name == ModelNames.GEMINI:
+                    # nothing to load but the client, no paid warm-up call
+                    get_gemini_pool().get(os.environ.get("GOOGLE_API_KEY"))
+                else:
+                    model = load_backend(model_name)
+                    status.state = "warming"
+                    if sample is None:
+                        sample = load_image(WARMUP_SAMPLE)
+                    model.run(model.fit_input(sample))
+                status.state = "ready"
+            except Exception as err:
+                status.state = "failed"
+                status.error = repr(err)
+                logger.exception("Warm-up of %s failed", model_name.value)
+            status.seconds = time.perf_counter() - start
+            logger.info(
+                "Warm-up of %s: %s in %.1fs",
+                model_name.value,
+                status.state,
+                status.seconds,
+            )
+        self.ready_file.write_text(
+            "".join(f"{name.value}: {status.state}\n" for name, status in self.statuses.items())
+        )
+
+
+warmup = Warmup()
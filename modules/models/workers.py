@@ -0,0 +1,380 @@
+import logging
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass
+from io import BytesIO
+
+from PIL import Image
+
+from modules.data.receipt_data import ReceiptData
+from modules.utils import AIError
+from .base import AIModel
+from .cache import _deserialize, _serialize
+
+logger = logging.getLogger(__name__)
+
+# Number of inference worker processes, 0 runs inference in the sessions
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "0"))
+# Backends (ModelNames values) run by the workers, others run in-process
+WORKER_MODELS = os.getenv("WORKER_MODELS", "Donut,Donut (int8 CPU),LayoutLMv3").split(",")
+# Fork the workers from a server that preloaded the models, so that they
+# share the weights instead of loading a copy each
+PREFORK = os.getenv("INFERENCE_PREFORK", "0") == "1"
+# Seconds a job may run before its worker is restarted
+JOB_TIMEOUT = float(os.getenv("INFERENCE_JOB_TIMEOUT", "120"))
+# Seconds a receipt may wait for its result, time in the queue included
+JOB_DEADLINE = float(os.getenv("INFERENCE_JOB_DEADLINE", "600"))
+# Seconds between two polls of a job
+POLL_INTERVAL = 0.1
+# JPEG quality of the images sent to the workers, about a tenth of the raw
+# pixels at no visible loss
+TRANSFER_QUALITY = 95
+
+
+@dataclass
+class JobStatus:
+    """State of an inference job."""
+
+    # queued, running, done or failed
+    state: str
+    # jobs ahead of this one in the queue
+    position: int = 0
+    receipt: ReceiptData | None = None
+    error: str | None = None
+    seconds: float = 0.0
+
+
+@dataclass
+class ServiceStats:
+    """Load of the inference service, for display."""
+
+    workers: int
+    busy: int
+    queue_depth: int
+    # share of worker time spent on jobs since start, 0 to 1
+    utilization: float
+
+
+@dataclass
+class _Job:
+    id: str
+    submitted: float
+    started: float | None = None
+    # process id of the worker running it
+    worker: int | None = None
+    status: JobStatus | None = None
+
+
+class InferenceService:
+    """Pool of worker processes running local models for every session.
+
+    Jobs go through one FIFO queue, each worker takes the next job when it
+    is free and keeps the models it loaded for the following jobs. A worker
+    running a job past the timeout, or dying, is restarted and its job
+    fails.
+
+    Workers are spawned, each loading its own models, or in prefork mode
+    forked from a fork server that loaded the models once (see `prefork`).
+    The fork server is single threaded, unlike the Streamlit server, so
+    forking it is safe, and restarted workers share the weights too.
+    """
+
+    def __init__(
+        self,
+        workers: int = INFERENCE_WORKERS,
+        job_timeout: float = JOB_TIMEOUT,
+        prefork: bool = PREFORK,
+    ) -> None:
+        """
+        Args:
+            workers (int, optional): number of worker processes
+            job_timeout (float, optional): seconds a job may run
+            prefork (bool, optional): fork the workers from a fork server
+                that preloaded the models, where available
+        """
+        self.workers = max(workers, 1)
+        self.job_timeout = job_timeout
+        self.prefork = prefork and "forkserver" in multiprocessing.get_all_start_methods()
+        if self.prefork:
+            self._context = multiprocessing.get_context("forkserver")
+            self._context.set_forkserver_preload(["modules.models.prefork"])
+        else:
+            # forking the multi-threaded server process is unsafe
+            self._context = multiprocessing.get_context("spawn")
+        self._tasks = self._context.Queue()
+        self._results = self._context.Queue()
+        self._processes: list[multiprocessing.Process] = []
+        self._jobs: dict[str, _Job] = {}
+        self._queued: deque[str] = deque()
+        # job of each busy worker, by process id, so that a message from a
+        # worker that was since restarted is never taken for its successor's
+        self._running: dict[int, str] = {}
+        self._lock = threading.Lock()
+        self._started_at = time.monotonic()
+        self._busy_seconds = 0.0
+        self._stopping = False
+
+    def start(self) -> None:
+        """Start the workers and the result collector."""
+        self._processes = [self._spawn(index) for index in range(self.workers)]
+        threading.Thread(target=self._collect, name="inference-results", daemon=True).start()
+
+    def stop(self) -> None:
+        """Stop the workers once they finished their current job."""
+        self._stopping = True
+        for _ in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=self.job_timeout)
+            if process.is_alive():
+                process.terminate()
+        self._processes = []
+
+    def pids(self) -> list[int]:
+        """Process ids of the workers."""
+        return [process.pid for process in self._processes]
+
+    def submit(self, model_name: str, image: Image.Image) -> str:
+        """Queue a receipt for reading.
+
+        Args:
+            model_name (str): ModelNames value of the backend
+            image (Image.Image): the receipt photo image
+
+        Returns:
+            str: job id to poll
+        """
+        job_id = uuid.uuid4().hex
+        buffer = BytesIO()
+        image.convert("RGB").save(buffer, format="JPEG", quality=TRANSFER_QUALITY)
+        with self._lock:
+            self._jobs[job_id] = _Job(job_id, time.monotonic())
+            self._queued.append(job_id)
+        self._tasks.put((job_id, model_name, buffer.getvalue()))
+        return job_id
+
+    def poll(self, job_id: str) -> JobStatus:
+        """Get the state of a job, finished jobs are forgotten once polled.
+
+        Args:
+            job_id (str): id returned by `submit`
+
+        Returns:
+            JobStatus: the job state
+        """
+        with self._lock:
+            job = self._jobs[job_id]
+            if job.status is not None:
+                del self._jobs[job_id]
+                return job.status
+            if job.started is None:
+                return JobStatus("queued", position=self._queued.index(job_id))
+            return JobStatus("running", seconds=time.monotonic() - job.started)
+
+    def cancel(self, job_id: str) -> None:
+        """Stop tracking a job, its result is dropped when it arrives."""
+        with self._lock:
+            self._jobs.pop(job_id, None)
+            if job_id in self._queued:
+                self._queued.remove(job_id)
+
+    def stats(self) -> ServiceStats:
+        """Current queue depth and worker utilization."""
+        now = time.monotonic()
+        with self._lock:
+            busy_seconds = self._busy_seconds + sum(
+                now - self._jobs[job_id].started
+                for job_id in self._running.values()
+                if job_id in self._jobs and self._jobs[job_id].started is not None
+            )
+            return ServiceStats(
+                workers=self.workers,
+                busy=len(self._running),
+                queue_depth=len(self._queued),
+                utilization=busy_seconds / max((now - self._started_at) * self.workers, 1e-9),
+            )
+
+    def _spawn(self, index: int) -> multiprocessing.Process:
+        process = self._context.Process(
+            target=_worker_main,
+            args=(self.workers, self._tasks, self._results),
+            name=f"inference-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        return process
+
+    def _collect(self) -> None:
+        while True:
+            if self._stopping:
+                return
+            # handle everything received before looking for dead workers,
+            # so that a crashed worker's last messages are seen first
+            messages = []
+            try:
+                messages.append(self._results.get(timeout=1.0))
+                while True:
+                    messages.append(self._results.get_nowait())
+            except queue.Empty:
+                pass
+            for message in messages:
+                self._handle(*message)
+            self._check_workers()
+
+    def _handle(self, kind: str, job_id: str, worker: int, payload=None, error=None) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if kind == "start":
+                if job_id in self._queued:
+                    self._queued.remove(job_id)
+                job = self._jobs.get(job_id)
+                if worker not in self.pids():
+                    # the worker died and was restarted before its start
+                    # message arrived
+                    if job is not None:
+                        job.status = JobStatus("failed", error="Inference job worker crashed")
+                    return
+                self._running[worker] = job_id
+                if job is not None:
+                    job.started, job.worker = now, worker
+                return
+
+            if self._running.get(worker) == job_id:
+                del self._running[worker]
+            job = self._jobs.get(job_id)
+            if job is None:
+                # cancelled, or timed out and already failed
+                return
+            seconds = now - (job.started or now)
+            self._busy_seconds += seconds
+            if error is None:
+                job.status = JobStatus("done", receipt=_deserialize(payload), seconds=seconds)
+            else:
+                job.status = JobStatus("failed", error=error, seconds=seconds)
+
+    def _check_workers(self) -> None:
+        now = time.monotonic()
+        for index, process in enumerate(self._processes):
+            with self._lock:
+                job_id = self._running.get(process.pid)
+                job = self._jobs.get(job_id) if job_id is not None else None
+                timed_out = (
+                    job is not None
+                    and job.started is not None
+                    and now - job.started > self.job_timeout
+                )
+                if not timed_out and process.is_alive():
+                    continue
+                if job_id is not None:
+                    del self._running[process.pid]
+                if job is not None:
+                    reason = "timed out" if timed_out else "worker crashed"
+                    job.status = JobStatus("failed", error=f"Inference job {reason}")
+                    self._busy_seconds += now - (job.started or now)
+
+            logger.warning("Restarting inference worker %d", index)
+            if process.is_alive():
+                process.terminate()
+            process.join(timeout=5)
+            self._processes[index] = self._spawn(index)
+
+
+class RemoteModel(AIModel):
+    """A backend run by the inference service, polled until it answers.
+
+    Images are downscaled to the backend's size before they are sent, as
+    the backend would, so the payload is small and cache keys match the
+    in-process backend.
+    """
+
+    def __init__(
+        self, service: InferenceService, model_name: str, input_max_side: int | None = None
+    ) -> None:
+        """
+        Args:
+            service (InferenceService): the running service
+            model_name (str): ModelNames value of the backend
+            input_max_side (int | None, optional): the backend's
+                `input_max_side`, its model is not loaded in this process
+        """
+        self.service = service
+        self.model_name = model_name
+        self.input_max_side = input_max_side
+
+    def run(self, image: Image.Image) -> ReceiptData:
+        return self.run_batch([image])[0]
+
+    def run_batch(self, images: list[Image.Image]) -> list[ReceiptData]:
+        # spread over the workers, polled in order
+        deadline = time.monotonic() + JOB_DEADLINE
+        job_ids = [
+            self.service.submit(self.model_name, self.fit_input(image)) for image in images
+        ]
+        try:
+            return [self._wait(job_id, deadline) for job_id in job_ids]
+        finally:
+            for job_id in job_ids:
+                self.service.cancel(job_id)
+
+    def _wait(self, job_id: str, deadline: float) -> ReceiptData:
+        # a job whose worker died before reporting its start is never
+        # failed by the service, it would stay queued forever
+        while time.monotonic() < deadline:
+            status = self.service.poll(job_id)
+            if status.state == "done":
+                return status.receipt
+            if status.state == "failed":
+                raise AIError(f"{self.model_name} failed to read the receipt: {status.error}")
+            time.sleep(POLL_INTERVAL)
+        raise AIError(
+            f"{self.model_name} did not read the receipt within {JOB_DEADLINE:.0f}s"
+        )
+
+
+def _worker_main(
+    workers: int, tasks: multiprocessing.Queue, results: multiprocessing.Queue
+) -> None:
+    """Loop of a worker process: take a job, read the receipt, send the result."""
+    # split the cores between the workers, read by `threads` when imported
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    cores = int(os.getenv("INFERENCE_CPU_THREADS", str(cores or 1)))
+    os.environ["INFERENCE_CPU_THREADS"] = str(max(cores // workers, 1))
+
+    from .loader import ModelNames, _create_model
+    from .residency import ResidencyManager
+
+    # present when forked from the prefork server, never imported here as
+    # importing it loads the models
+    prefork = sys.modules.get("modules.models.prefork")
+    if prefork is not None:
+        prefork.restore_threads()
+    threads = sys.modules.get("modules.models.threads")
+    if threads is not None:
+        # imported by the fork server already
+        threads.cpu_threads.resize(int(os.environ["INFERENCE_CPU_THREADS"]))
+
+    def create(name: str) -> AIModel:
+        model = prefork.take(name) if prefork is not None else None
+        return model if model is not None else _create_model(ModelNames(name))
+
+    models = ResidencyManager(create)
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        job_id, model_name, data = task
+        pid = os.getpid()
+        results.put(("start", job_id, pid))
+        try:
+            model = models.load(model_name)
+            image = Image.open(BytesIO(data)).convert("RGB")
+            receipt = model.run(model.fit_input(image))
+            results.put(("done", job_id, pid, _serialize(receipt)))
+        except Exception as err:
+            results.put(("done", job_id, pid, None, repr(err)))
@@ -1,13 +1,18 @@
-from typing import Callable
+import time
+from typing import Callable, Iterator
 
 import streamlit as st
-from PIL import Image
+from PIL import Image, ImageDraw
 
 from modules.data import session_data
-from modules.data.receipt_data import ReceiptData
+from modules.data.receipt_data import ItemData, ReceiptData
+from modules.models.crop import Quad, crop_receipt, detect_receipt
+from modules.models.ingest import load_image
 from modules.utils import format_number_to_currency
 
 IMAGE_DISPLAY_HEIGHT = 480
+# Seconds between checks while a receipt waits for a warming model
+WARMUP_POLL_SECONDS = 2
 
 
 def get_items_table_columns_config() -> dict:
@@ -57,28 +62,49 @@ def image_input_view() -> Image.Image | None:
     )
     if uploaded_file is None:
         return session_data.image.get()
-    image = Image.open(uploaded_file)
-    session_data.image.set(image)
-    return image
+    # decode each upload once, not on every rerun
+    if session_data.image_file_id.get() != uploaded_file.file_id:
+        image = load_image(uploaded_file)
+        session_data.image.set(image)
+        session_data.receipt_quad.set(detect_receipt(image))
+        session_data.image_file_id.set(uploaded_file.file_id)
+    return session_data.image.get()
 
 
 @st.dialog("Reading your receipt...")
 def read_receipt_view(
-    receipt_reader: Callable[[Image.Image], ReceiptData], image: Image.Image
+    receipt_reader: Callable[[Image.Image], Iterator[ItemData | ReceiptData]],
+    image: Image.Image,
 ) -> None:
     """Pop-up when AI reading the receipt.
 
+    Items are shown in a table as soon as the AI reads them, while the
+    rest of the receipt is still being read.
+
     Args:
-        receipt_reader (Callable[[Image.Image], ReceiptData]): the callable
-            that will trigger the AI to run inference on the image
+        receipt_reader (Callable[[Image.Image], Iterator[ItemData | ReceiptData]]):
+            the callable that will trigger the AI to run inference on the
+            image, yielding items as they are read and the receipt data last
         image (Image.Image): uploaded image by user
     """
     _, col2, _ = st.columns([4.75, 0.5, 4.75])
+    items_placeholder = st.empty()
+    partial_items = {}
+    receipt = None
     with col2:
         with st.spinner(""):
-            receipt = receipt_reader(image)
-            session_data.view1_model_result.set(receipt)
-            st.rerun()
+            for result in receipt_reader(image):
+                if isinstance(result, ReceiptData):
+                    receipt = result
+                    continue
+                partial_items[result.id] = result
+                items_placeholder.dataframe(
+                    ReceiptData(items=partial_items, total=0.0).to_items_df(),
+                    hide_index=True,
+                    column_config=get_items_table_columns_config(),
+                )
+    session_data.view1_model_result.set(receipt)
+    st.rerun()
 
 
 @st.dialog("Confirm Data")
@@ -90,6 +116,18 @@ def receipt_read_confirmation_view(receipt: ReceiptData) -> None:
     """
     # confirm items data
     st.markdown("### Are these data correct?")
+    if receipt.fallback:
+        st.warning(
+            "The selected model is temporarily unavailable, this receipt was "
+            f"read by {receipt.source} instead."
+        )
+    elif receipt.cached and receipt.read_seconds is not None:
+        first_read = f", first read by {receipt.source}" if receipt.source else ""
+        st.caption(
+            f"Read from the cache in {receipt.read_seconds:.2f}s{first_read}."
+        )
+    elif receipt.source is not None and receipt.read_seconds is not None:
+        st.caption(f"Read by {receipt.source} in {receipt.read_seconds:.1f}s.")
     st.caption("Note: You can **edit** cells, **add** new rows, or **delete** rows (select row and press **Delete**).")
     edited_data = st.data_editor(
         receipt.to_items_df(),
@@ -119,13 +157,20 @@ def receipt_read_confirmation_view(receipt: ReceiptData) -> None:
         st.rerun()
 
 
-def image_preview_view(image: Image.Image) -> None:
+def image_preview_view(image: Image.Image, quad: Quad | None = None) -> None:
     """Eelemnt to preview the uploaded image.
 
     Args:
         image (Image.Image): the uploaded image
+        quad (Quad | None, optional): detected receipt corners, outlined
+            on the preview. Defaults to None.
     """
-    st.image(resize_to_height(image, IMAGE_DISPLAY_HEIGHT), use_container_width=True)
+    preview = resize_to_height(image, IMAGE_DISPLAY_HEIGHT)
+    if quad is not None:
+        scale = preview.height / image.height
+        outline = [(x * scale, y * scale) for x, y in quad]
+        ImageDraw.Draw(preview).polygon(outline, outline="#ff4b4b", width=3)
+    st.image(preview, use_container_width=True)
 
 
 def final_receipt_view() -> None:
@@ -146,31 +191,61 @@ def final_receipt_view() -> None:
     st.markdown('</div>', unsafe_allow_html=True)
 
 
-def controller(receipt_reader: Callable[[Image.Image], ReceiptData]) -> bool:
+def model_warmup_view(model_names: list[str]) -> None:
+    """Notice shown while the selected model loads in the background.
+
+    Args:
+        model_names (list[str]): names of the models still warming up
+    """
+    st.info(
+        f"{', '.join(model_names)} is warming up, your receipt will be read "
+        "as soon as it is ready.",
+        icon=":material/hourglass_top:",
+    )
+
+
+def controller(
+    receipt_reader: Callable[[Image.Image], Iterator[ItemData | ReceiptData]] | None,
+    warming_models: list[str] | None = None,
+) -> bool:
     """Main controller of the page 1, receipt upload.
 
     Args:
-        receipt_reader (Callable[[Image.Image], ReceiptData]): the callable
-            that will trigger the AI to run inference on the image
+        receipt_reader (Callable[[Image.Image], Iterator[ItemData | ReceiptData]] | None):
+            the callable that will trigger the AI to run inference on the
+            image, yielding items as they are read and the receipt data last.
+            None while the model is warming up.
+        warming_models (list[str] | None, optional): names of the models
+            still warming up. Defaults to None.
 
     Returns:
         bool: True if user has completed all required actions in
         this page
     """
+    if receipt_reader is None:
+        model_warmup_view(warming_models or [])
     image = image_input_view()
     if image is None:
         return False
+    waiting_for_model = False
     if session_data.receipt_data.get() is None:
         reading_data = session_data.view1_model_result.get_once()
-        if reading_data is None:
-            read_receipt_view(receipt_reader, image)
+        if reading_data is None and receipt_reader is None:
+            waiting_for_model = True
+        elif reading_data is None:
+            # only the detected receipt is sent to the AI
+            receipt_image = crop_receipt(image, session_data.receipt_quad.get())
+            read_receipt_view(receipt_reader, receipt_image)
         else:
             receipt_read_confirmation_view(reading_data)
 
     st.markdown("### Your receipt data")
     col1, col2 = st.columns([3, 7])
     with col1:
-        image_preview_view(image)
+        image_preview_view(image, session_data.receipt_quad.get())
     with col2:
         final_receipt_view()
+    if waiting_for_model:
+        time.sleep(WARMUP_POLL_SECONDS)
+        st.rerun()
     return session_data.view1_auto_next_page.get_once()
\ No newline at end of file
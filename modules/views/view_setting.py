@@ -1,11 +1,18 @@
-import os
+import time
 from dataclasses import dataclass, field
 
 import streamlit as st
 from babel.numbers import get_currency_name
 
 from modules.data import session_data
-from modules.models.loader import ModelNames
+from modules.models.loader import (
+    ModelNames,
+    get_extraction_cache,
+    get_inference_service,
+    get_residency_manager,
+    get_stage_names,
+)
+from modules.models.rate_limit import gemini_limiter
 from modules.utils import CURRENCY_LIST
 
 
@@ -15,9 +22,7 @@ class SettingsData:
 
     currency: str = field(default_factory=session_data.currency.get)
     model_name: ModelNames = field(default_factory=session_data.model_name.get)
-    gemini_api_key: str | None = field(
-        default_factory=lambda: os.environ.get("GOOGLE_API_KEY")
-    )
+    gemini_api_key: str | None = field(default_factory=session_data.gemini_api_key.get)
 
     def apply(self) -> None:
         """Apply the settings stored in this object."""
@@ -25,8 +30,11 @@ class SettingsData:
         if self.model_name != session_data.model_name.get():
             session_data.model.reset()
         session_data.model_name.set(self.model_name)
+        # kept per session, never written to the process environment
         if self.gemini_api_key is not None and self.gemini_api_key != "":
-            os.environ["GOOGLE_API_KEY"] = self.gemini_api_key
+            if self.gemini_api_key != session_data.gemini_api_key.get():
+                session_data.model.reset()
+            session_data.gemini_api_key.set(self.gemini_api_key)
 
 
 def currency_settings_view(settings: SettingsData) -> SettingsData:
@@ -73,15 +81,87 @@ def model_selection_view(settings: SettingsData) -> SettingsData:
         format_func=lambda x: x.value,
         index=current_idx,
     )
-    if selected_model == ModelNames.GEMINI:
+    if ModelNames.GEMINI in get_stage_names(selected_model):
         google_key = st.text_input(
             "Google API Key", type="password", value=settings.gemini_api_key
         )
         settings.gemini_api_key = google_key
+        gemini_status_view()
+    model_residency_view()
+    inference_service_view()
+    extraction_cache_view()
     settings.model_name = selected_model
     return settings
 
 
+def inference_service_view() -> None:
+    """Element showing the load of the inference worker processes."""
+    service = get_inference_service()
+    if service is None:
+        return
+    stats = service.stats()
+    st.caption(
+        f"Inference workers: {stats.busy}/{stats.workers} busy, "
+        f"{stats.queue_depth} receipts queued, "
+        f"{stats.utilization:.0%} utilization since start."
+    )
+
+
+def extraction_cache_view() -> None:
+    """Element showing how many receipts the extraction cache served."""
+    stats = get_extraction_cache().stats
+    lookups = stats.hits + stats.misses
+    if lookups == 0:
+        return
+    st.caption(
+        f"Extraction cache: {stats.hits}/{lookups} receipts served from the cache "
+        f"({stats.memory_hits} in memory, {stats.disk_hits} on disk, "
+        f"{stats.perceptual_hits} by a similar photo)."
+    )
+
+
+def model_residency_view() -> None:
+    """Element showing the loaded models and their memory use."""
+    manager = get_residency_manager()
+    residents = manager.residents()
+    if residents:
+        loaded = ", ".join(
+            f"{key.value} ({size / 2**20:,.0f} MB)" for key, size in reversed(residents)
+        )
+        st.caption(f"Loaded models: {loaded}.")
+    if manager.events:
+        with st.expander("Model memory events"):
+            st.dataframe(
+                [
+                    {
+                        "time": time.strftime("%H:%M:%S", time.localtime(event.time)),
+                        "event": event.kind,
+                        "model": event.model,
+                        "size (MB)": round(event.size / 2**20),
+                        "process RSS (MB)": round(event.rss / 2**20),
+                        "seconds": round(event.seconds, 1),
+                    }
+                    for event in reversed(manager.events)
+                ],
+                hide_index=True,
+            )
+
+
+def gemini_status_view() -> None:
+    """Element showing the shared Gemini quota and circuit breaker state."""
+    state = gemini_limiter.state()
+    st.caption(
+        f"Gemini quota: {state.requests_available:.0f}/{state.requests_per_minute:.0f} "
+        f"requests and {state.tokens_available:,.0f}/{state.tokens_per_minute:,.0f} "
+        f"tokens available this minute, {state.waiting} waiting."
+    )
+    if state.breaker != "closed":
+        st.warning(
+            f"Gemini is failing repeatedly (circuit breaker {state.breaker}), "
+            "receipts are read with a local model meanwhile."
+        )
+
+
 @st.dialog("Settings")
 def controller(error_msg: str | None = None) -> None:
     """Controller of the settings page pop-up.
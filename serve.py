@@ -0,0 +1,21 @@
+"""
+Start the Streamlit server with the AI models warming up in the background.
+
+Usage: python serve.py [streamlit run options]
+"""
+
+import sys
+
+from streamlit.web import cli
+
+from modules.models.warmup import warmup
+
+
+def main() -> None:
+    warmup.start()
+    sys.argv = ["streamlit", "run", "app.py", *sys.argv[1:]]
+    cli.main()
+
+
+if __name__ == "__main__":
+    main()